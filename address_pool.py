@@ -0,0 +1,106 @@
+"""Deposit addresses generated ahead of time and handed out by /address.
+
+The deposit checker keeps at least a low-water mark of unclaimed
+addresses in address_pool. It adds them in batches of getnewaddress
+calls sent as one JSON-RPC request. /address claims one in a single
+statement. The statement locks the user's balances row, checks its
+address_count against the limit, takes the oldest unclaimed address with
+FOR UPDATE SKIP LOCKED (so concurrent claims never wait on each other),
+records it in addresses and bumps address_count. No RPC and no COUNT(*)
+on the way.
+
+If the pool runs dry /address falls back to getnewaddress and assign(),
+which does the same bookkeeping for an address it is given.
+"""
+
+import logging
+
+from structured_log import event
+
+POOL_LABEL = "pool"
+
+_ASSIGN = """
+WITH locked AS (
+    SELECT address_count FROM balances WHERE user_id = $1 FOR UPDATE
+), claimed AS (
+    {claim}
+), assigned AS (
+    INSERT INTO addresses (user_id, address) SELECT $1, address FROM claimed
+), counted AS (
+    INSERT INTO balances (user_id, address_count) SELECT $1, 1 FROM claimed
+    ON CONFLICT (user_id) DO UPDATE SET address_count = balances.address_count + 1
+    RETURNING address_count
+)
+SELECT
+    (SELECT address FROM claimed) AS address,
+    COALESCE((SELECT address_count FROM counted), (SELECT address_count FROM locked), 0) AS count
+"""
+
+CLAIM = _ASSIGN.format(claim="""
+    UPDATE address_pool SET user_id = $1, claimed_at = now()
+    WHERE id = (
+        SELECT id FROM address_pool WHERE user_id IS NULL
+        ORDER BY id LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ) AND COALESCE((SELECT address_count FROM locked), 0) < $2
+    RETURNING address
+""")
+
+ASSIGN = _ASSIGN.format(claim="""
+    INSERT INTO address_pool (address, user_id, claimed_at)
+    SELECT $3, $1, now() WHERE COALESCE((SELECT address_count FROM locked), 0) < $2
+    RETURNING address
+""")
+
+
+async def claim(conn, user_id, limit):
+    """Gives the user an address from the pool.
+
+    Returns (address, count), count being the user's number of addresses.
+    address is None if the user is at the limit (count >= limit) or the
+    pool is empty.
+    """
+    row = await conn.fetchrow(CLAIM, user_id, limit)
+    return row["address"], row["count"]
+
+
+async def assign(conn, user_id, address, limit):
+    """Gives the user an address generated for them, same result as claim()"""
+    row = await conn.fetchrow(ASSIGN, user_id, limit, address)
+    return row["address"], row["count"]
+
+
+async def depth(conn):
+    return await conn.fetchval("SELECT COUNT(*) FROM address_pool WHERE user_id IS NULL")
+
+
+async def refill(conn, rpc, low_water, batch_size):
+    """Adds batches of new addresses until at least low_water are unclaimed.
+
+    Returns (depth, added).
+    """
+    unclaimed = await depth(conn)
+    added = 0
+    while unclaimed < low_water:
+        addresses = await rpc.batch([("getnewaddress", [POOL_LABEL])] * batch_size)
+        inserted = await conn.fetchval(
+            """
+            WITH inserted AS (
+                INSERT INTO address_pool (address) SELECT unnest($1::text[])
+                ON CONFLICT (address) DO NOTHING
+                RETURNING 1
+            )
+            SELECT COUNT(*) FROM inserted
+            """,
+            addresses,
+        )
+        unclaimed += inserted
+        added += inserted
+        if not inserted:
+            break  # bitcoind keeps returning known addresses, try again later
+    if added:
+        logging.info(
+            "Added %s addresses to the pool, %s unclaimed", added, unclaimed,
+            extra=event("address_pool_refilled", added=added, depth=unclaimed),
+        )
+    return unclaimed, added
@@ -0,0 +1,57 @@
+"""Bounded LRU cache of user balances with a TTL.
+
+Used for the cheap "can this user afford it" checks in handlers. Writers
+update it with the balance the database returned, other processes
+invalidate entries through Postgres NOTIFY on BALANCE_CHANNEL. Anything
+that moves money still checks the balance in the database.
+"""
+
+import time
+from collections import OrderedDict
+
+BALANCE_CHANNEL = "balance_changed"
+
+MISSING = object()
+
+
+class BalanceCache:
+    def __init__(self, max_size=10_000, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user_id -> (balance, expires_at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        """The cached balance (None when the user has no row), or MISSING"""
+        entry = self.entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self.entries[user_id]
+            self.misses += 1
+            return MISSING
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id, balance):
+        self.entries[user_id] = (balance, time.monotonic() + self.ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
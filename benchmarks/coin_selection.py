@@ -0,0 +1,70 @@
+"""Coin selection on synthetic wallets of 10k to 1M UTXOs.
+
+Values are log-normally distributed around 100k sats with a tail of dust,
+roughly what a deposit wallet accumulates. For each wallet size this
+times building the index, incremental updates and selections for a
+range of batch amounts:
+
+    python -m benchmarks.coin_selection
+    python -m benchmarks.coin_selection --sizes 10000 100000
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from coin_selection import UtxoIndex, select_coins
+
+AMOUNTS = [10_000, 250_000, 5_000_000, 100_000_000]
+FEE_RATE = 3
+
+
+def synthetic_utxos(n, rng):
+    for i in range(n):
+        sats = 546 + int(rng.lognormvariate(11.5, 2.0)) if rng.random() > 0.1 else rng.randint(300, 2000)
+        yield f"{i:064x}", rng.randint(0, 3), sats
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    rng = random.Random(1)
+
+    for n in args.sizes:
+        index = UtxoIndex()
+        _, build_ms = timed(index.replace_all, list(synthetic_utxos(n, rng)))
+
+        updates = []
+        for i in range(1000):
+            _, ms = timed(index.add, f"new{i}", 0, rng.randint(1000, 10**7))
+            updates.append(ms)
+            _, ms = timed(index.remove, f"new{i}", 0)
+            updates.append(ms)
+
+        print(f"{n} UTXOs: index built in {build_ms:.0f} ms, add/remove p50 {statistics.median(updates) * 1000:.1f} us")
+        for amount in AMOUNTS:
+            timings, algorithms, inputs, waste = [], {}, [], []
+            for _ in range(args.rounds):
+                target = int(amount * rng.uniform(0.9, 1.1))
+                selection, ms = timed(select_coins, index, target, FEE_RATE)
+                timings.append(ms)
+                algorithms[selection.algorithm] = algorithms.get(selection.algorithm, 0) + 1
+                inputs.append(len(selection.outpoints))
+                waste.append(selection.total - target - selection.change)
+            print(
+                f"  {amount:>11} sats: p50 {statistics.median(timings):7.2f} ms, max {max(timings):7.2f} ms, "
+                f"inputs {statistics.mean(inputs):.1f}, fee+waste {statistics.mean(waste):.0f} sats, {algorithms}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Statistical checks and replay throughput for fair_random.
+
+Draws winners for millions of simulated flips and runs a chi-square test
+of the winning positions against the expected distribution, for single,
+multi-winner and weighted draws. Then times settling and replaying a
+batch of flips. Exits non-zero if any distribution looks biased:
+
+    python -m benchmarks.fair_random
+    python -m benchmarks.fair_random --draws 5000000 --alpha 1e-6
+"""
+
+import argparse
+import secrets
+import sys
+import time
+
+import fair_random
+
+SIZES = [2, 3, 7, 10, 100]
+WEIGHTS = [1, 2, 3, 10, 100, 1000]
+
+
+def seeds(n):
+    pool = secrets.token_bytes(fair_random.SEED_BYTES * n)
+    return [pool[i : i + fair_random.SEED_BYTES] for i in range(0, len(pool), fair_random.SEED_BYTES)]
+
+
+def position_counts(n_draws, ids, k=1, weights=None):
+    counts = [0] * len(ids)
+    for seed in seeds(n_draws):
+        for i in fair_random.draw_indices(seed, ids, k, weights):
+            counts[i] += 1
+    return counts
+
+
+def check(name, counts, expected, alpha):
+    statistic, p = fair_random.chi_square(counts, expected)
+    ok = p >= alpha
+    print(f"{name:<28} chi2 {statistic:10.1f}  dof {len(counts) - 1:4}  p {p:.4f}  {'ok' if ok else 'BIASED'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--draws", type=int, default=1_000_000, help="simulated draws per distribution")
+    parser.add_argument("--alpha", type=float, default=1e-4)
+    parser.add_argument("--flips", type=int, default=10_000, help="flips to settle and replay")
+    args = parser.parse_args()
+
+    ok = True
+    start = time.perf_counter()
+    for n in SIZES:
+        ids = list(range(1000, 1000 + n))
+        counts = position_counts(args.draws, ids)
+        ok &= check(f"uniform n={n}", counts, [args.draws / n] * n, args.alpha)
+
+    ids = list(range(10))
+    counts = position_counts(args.draws // 3, ids, k=3)
+    ok &= check("3 winners of 10", counts, [args.draws // 3 * 3 / 10] * 10, args.alpha)
+
+    ids = list(range(len(WEIGHTS)))
+    counts = position_counts(args.draws, ids, weights=WEIGHTS)
+    total = sum(WEIGHTS)
+    ok &= check("weighted", counts, [args.draws * w / total for w in WEIGHTS], args.alpha)
+    print(f"Simulated draws took {time.perf_counter() - start:.1f}s")
+
+    flip_seeds = seeds(args.flips)
+    participants = [list(range(i, i + 2 + i % 99)) for i in range(args.flips)]
+    start = time.perf_counter()
+    winners = fair_random.draw_batch(flip_seeds, participants)
+    settle_ms = (time.perf_counter() - start) * 1000
+    results = [
+        {"seed": s, "commitment": fair_random.commitment(s), "participants": p, "winners": w}
+        for s, p, w in zip(flip_seeds, participants, winners)
+    ]
+    start = time.perf_counter()
+    bad = fair_random.replay(results)
+    replay_ms = (time.perf_counter() - start) * 1000
+    print(
+        f"{args.flips} flips: drawn in {settle_ms:.0f} ms, replayed in {replay_ms:.0f} ms, "
+        f"{len(bad)} failed to verify"
+    )
+    ok &= not bad
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
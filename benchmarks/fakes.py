@@ -0,0 +1,212 @@
+"""Stand-ins for Telegram and bitcoind used by the benchmarks.
+
+RecordingBot answers the Bot API calls the handlers make and records
+them with a configurable latency. The update builders return real
+telegram Update objects bound to it, so handlers run unmodified.
+
+StubBitcoind is a JSON-RPC server on a background thread serving a
+synthetic wallet: getnewaddress, validateaddress, listsinceblock,
+gettransaction, listunspent, getbalances and send.
+"""
+
+import asyncio
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from telegram import Update
+
+
+class RecordingBot:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}  # method -> count
+        self._message_ids = itertools.count(1_000_000)
+
+    async def _record(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._record("send_message")
+        return SimpleNamespace(message_id=next(self._message_ids), chat_id=chat_id, text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await self._record("edit_message_text")
+        return True
+
+    async def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        await self._record("answer_callback_query")
+        return True
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+
+def command_update(bot, update_id, chat_id, user_id, text, message_id=None):
+    return Update.de_json(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": message_id or update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                "from": _user(user_id),
+                "text": text,
+            },
+        },
+        bot,
+    )
+
+
+def callback_update(bot, update_id, chat_id, user_id, data, message_id=1):
+    return Update.de_json(
+        {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "chat_instance": str(chat_id),
+                "data": data,
+                "from": _user(user_id),
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "group"},
+                },
+            },
+        },
+        bot,
+    )
+
+
+def context(*args):
+    """The parts of CallbackContext the handlers use"""
+    return SimpleNamespace(args=[str(a) for a in args])
+
+
+class StubBitcoind:
+    """JSON-RPC server for a wallet of synthetic receive outputs.
+
+    wallet is a list of (address, sats) deposits, each its own transaction.
+    """
+
+    def __init__(self, wallet=(), latency=0.0):
+        self.wallet = list(wallet)
+        self.latency = latency
+        self.calls = {}
+        self._addresses = itertools.count()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _txid(self, i):
+        return f"{i:064x}"
+
+    def _receive(self, i):
+        address, sats = self.wallet[i]
+        return {
+            "address": address,
+            "category": "receive",
+            "amount": sats / 100_000_000,
+            "vout": 0,
+            "confirmations": 6,
+            "txid": self._txid(i),
+        }
+
+    def dispatch(self, method, params):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getnewaddress":
+            return f"bcrt1qstub{next(self._addresses):030d}"
+        if method == "validateaddress":
+            return {"isvalid": True, "address": params[0]}
+        if method == "listsinceblock":
+            return {
+                "transactions": [self._receive(i) for i in range(len(self.wallet))],
+                "removed": [],
+                "lastblock": "00" * 32,
+            }
+        if method == "gettransaction":
+            i = int(params[0], 16)
+            tx = self._receive(i)
+            return {"txid": tx["txid"], "confirmations": 6, "fee": -0.00000300, "details": [tx]}
+        if method == "decoderawtransaction":
+            # Stand-in raw transactions are just the txid, see benchmarks/zmq_notify.py
+            i = int(params[0], 16)
+            address, sats = self.wallet[i]
+            return {
+                "txid": self._txid(i),
+                "vout": [{"n": 0, "value": sats / 100_000_000, "scriptPubKey": {"address": address}}],
+            }
+        if method == "listunspent":
+            addresses = set(params[2]) if len(params) > 2 else None
+            return [
+                {"txid": self._txid(i), "vout": 0, "address": address, "amount": sats / 100_000_000, "spendable": True}
+                for i, (address, sats) in enumerate(self.wallet)
+                if addresses is None or address in addresses
+            ]
+        if method == "getbalances":
+            return {"mine": {"trusted": sum(s for _, s in self.wallet) / 100_000_000}}
+        if method == "send":
+            return {"complete": True, "txid": "ff" * 32}
+        raise KeyError(method)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                def answer(call):
+                    try:
+                        return {"result": stub.dispatch(call["method"], call["params"]), "error": None, "id": call["id"]}
+                    except KeyError:
+                        return {"result": None, "error": {"code": -32601, "message": "Method not found"}, "id": call["id"]}
+
+                reply = [answer(c) for c in request] if isinstance(request, list) else answer(request)
+                body = json.dumps(reply).encode()
+                self.send_response(500 if isinstance(reply, dict) and reply["error"] else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def percentiles(latencies):
+    """(p50, p99, max) of a list of milliseconds"""
+    if not latencies:
+        return 0.0, 0.0, 0.0
+    ordered = sorted(latencies)
+    return (
+        ordered[len(ordered) // 2],
+        ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+        ordered[-1],
+    )
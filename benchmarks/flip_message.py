@@ -0,0 +1,69 @@
+"""Cost of rendering the announcement on every join of a large flip.
+
+Compares rebuilding the whole text and keyboard on each join, as the bot
+used to, with the cached FlipMessage, and checks that every rendered
+message stays within Telegram's limit:
+
+    python -m benchmarks.flip_message --players 10 100 1000 5000
+"""
+
+import argparse
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from flip_message import MESSAGE_LIMIT, FlipMessage, text_length
+
+KEY = (-100, 1)
+
+
+def rebuild(flip):
+    participant_list = "\n".join([p[1] for p in flip["participants"]])
+    keyboard = [
+        [InlineKeyboardButton("Join", callback_data=f"join_{KEY[0]}_{KEY[1]}")],
+        [InlineKeyboardButton("Cancel", callback_data=f"cancel_{KEY[0]}_{KEY[1]}")],
+    ]
+    text = (
+        f"🎁 Giveflip started! {flip['sats']} sats given. {flip['max']} players needed."
+        f"\n\n🔒 Commitment: {'0' * 64}\n\nParticipants:\n{participant_list}"
+    )
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def join_all(n, render):
+    flip = {"sats": 1000, "max": n, "participants": [], "is_giveflip": True}
+    longest = 0
+    start = time.perf_counter()
+    for user_id in range(n):
+        flip["participants"].append((user_id, f"player_{user_id:06d}"))
+        text, _ = render(flip)
+        longest = max(longest, text_length(text))
+    return (time.perf_counter() - start) * 1000, longest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    args = parser.parse_args()
+
+    print(f"{'players':>8} {'rebuild ms':>11} {'longest':>8} {'cached ms':>10} {'longest':>8}")
+    for n in args.players:
+        cached = {}
+
+        def incremental(flip):
+            rendered = cached.get(KEY)
+            if rendered is None:
+                rendered = cached[KEY] = FlipMessage(KEY, flip, "0" * 64)
+            else:
+                rendered.sync(flip["participants"])
+            return rendered.text(), rendered.reply_markup
+
+        rebuild_ms, rebuild_longest = join_all(n, rebuild)
+        cached_ms, cached_longest = join_all(n, incremental)
+        print(f"{n:>8} {rebuild_ms:>11.1f} {rebuild_longest:>8} {cached_ms:>10.1f} {cached_longest:>8}")
+        if cached_longest > MESSAGE_LIMIT:
+            raise SystemExit(f"Rendered message of {cached_longest} characters exceeds {MESSAGE_LIMIT}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Telegram API calls during a join storm, with and without the edit scheduler.
+
+A fake Bot counts edit_message_text calls and answers with RetryAfter
+once a chat goes over its flood limit. Every chat gets a burst of joins
+spread over one second followed by the settlement edit:
+
+    python -m benchmarks.join_storm --chats 20 --joins 50
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from telegram.error import RetryAfter
+
+from edit_scheduler import EditScheduler
+
+
+class FakeBot:
+    """Allows `limit` edits per chat in any `window` seconds"""
+
+    def __init__(self, limit=20, window=60.0, latency=0.03):
+        self.limit = limit
+        self.window = window
+        self.latency = latency
+        self.calls = 0
+        self.flood_errors = 0
+        self.sent = {}  # chat_id -> [loop times]
+        self.delivered = {}  # (chat_id, message_id) -> (text, loop time)
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        now = asyncio.get_running_loop().time()
+        recent = [t for t in self.sent.get(chat_id, []) if t > now - self.window]
+        if len(recent) >= self.limit:
+            self.flood_errors += 1
+            raise RetryAfter(int(recent[0] + self.window - now) + 1)
+        self.sent[chat_id] = recent + [now]
+        self.delivered[(chat_id, message_id)] = (text, now)
+
+
+async def storm(chats, joins, edit):
+    loop = asyncio.get_running_loop()
+    settled_at = {}
+
+    async def chat(chat_id):
+        for i in range(joins):
+            await asyncio.sleep(random.random() * 2 / joins)
+            await edit(chat_id, 1, f"participants: {i + 1}", False)
+        settled_at[chat_id] = loop.time()
+        await edit(chat_id, 1, "won", True)
+
+    await asyncio.gather(*(chat(c) for c in range(chats)))
+    return settled_at
+
+
+async def naive(chats, joins):
+    bot = FakeBot()
+
+    async def edit(chat_id, message_id, text, final):
+        try:
+            await bot.edit_message_text(chat_id, message_id, text)
+        except RetryAfter:
+            pass
+
+    settled_at = await storm(chats, joins, edit)
+    return bot, settled_at
+
+
+async def scheduled(chats, joins):
+    bot = FakeBot()
+    scheduler = EditScheduler(bot)
+    scheduler.start()
+
+    async def edit(chat_id, message_id, text, final):
+        scheduler.schedule(chat_id, message_id, text, final=final)
+
+    settled_at = await storm(chats, joins, edit)
+    await scheduler.stop(timeout=120)
+    return bot, settled_at
+
+
+def report(name, bot, settled_at):
+    results = [bot.delivered.get((c, 1)) for c in settled_at]
+    won = [r for r in results if r and r[0] == "won"]
+    delays = sorted(r[1] - settled_at[c] for c, r in zip(settled_at, results) if r and r[0] == "won")
+    print(
+        f"{name:>10}: {bot.calls} API calls, {bot.flood_errors} flood errors, "
+        f"{len(won)}/{len(settled_at)} results shown"
+        + (f", result delay p50 {delays[len(delays) // 2] * 1000:.0f} ms max {delays[-1] * 1000:.0f} ms" if delays else "")
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--joins", type=int, default=50)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    report("naive", *await naive(args.chats, args.joins))
+    report("scheduled", *await scheduled(args.chats, args.joins))
+    print(f"({time.perf_counter() - start:.1f}s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
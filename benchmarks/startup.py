@@ -0,0 +1,86 @@
+"""Import time of each entry point, from `python -X importtime`.
+
+Imports cli, coinflipper and deposit_checker in fresh interpreters from
+another working directory, prints the median cumulative import time and
+the heaviest direct imports of each, and fails if a median is above its
+threshold or a module imports something it must not (the deposit
+checker loading python-telegram-bot):
+
+    python -m benchmarks.startup --runs 5 --threshold coinflipper=600
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Milliseconds, a few times what they take on a laptop
+THRESHOLDS = {"cli": 50, "coinflipper": 1000, "deposit_checker": 500}
+FORBIDDEN = {"cli": ["telegram", "asyncpg", "httpx"], "deposit_checker": ["telegram"]}
+
+
+def import_times(module):
+    """One import of module: (its cumulative ms, [(ms, name)] of its direct
+    imports, names of every module imported)"""
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=cwd,
+            env={**os.environ, "PYTHONPATH": ROOT},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    # A module's line follows those of the modules it imports, one level deeper
+    direct, names = [], set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        stripped = name.lstrip()
+        depth = (len(name) - len(stripped) - 1) // 2
+        ms = int(cumulative) / 1000
+        names.add(stripped)
+        if depth == 0 and stripped == module:
+            return ms, direct, names
+        if depth == 0:
+            direct = []
+        elif depth == 1:
+            direct.append((ms, stripped))
+    raise RuntimeError(f"{module} was not imported")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5, help="direct imports to list")
+    parser.add_argument("--threshold", action="append", default=[], metavar="MODULE=MS")
+    args = parser.parse_args()
+    thresholds = dict(THRESHOLDS)
+    for override in args.threshold:
+        name, ms = override.split("=")
+        thresholds[name] = float(ms)
+
+    failures = []
+    for module, threshold in thresholds.items():
+        runs = [import_times(module) for _ in range(args.runs)]
+        median = statistics.median(ms for ms, _, _ in runs)
+        print(f"{module}: {median:.1f} ms (threshold {threshold:.0f} ms)")
+        _, direct, names = runs[-1]
+        for ms, name in sorted(direct, reverse=True)[:args.top]:
+            print(f"  {name:<30} {ms:>8.1f} ms")
+        if median > threshold:
+            failures.append(f"{module} took {median:.1f} ms to import, over {threshold:.0f} ms")
+        for forbidden in FORBIDDEN.get(module, []):
+            if forbidden in names:
+                failures.append(f"{module} imports {forbidden}")
+    if failures:
+        raise SystemExit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    main()
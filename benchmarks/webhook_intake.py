@@ -0,0 +1,78 @@
+"""Webhook intake: POSTs synthetic Telegram updates at a bot running in
+webhook mode and times the responses.
+
+Start the bot with WEBHOOK_URL set (Telegram itself does not need to reach
+it), then point this at WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH:
+
+    python -m benchmarks.webhook_intake http://127.0.0.1:8443/telegram --joins 2000 --chats 50
+
+This only measures intake. The webhook answers 200 once an update is
+queued, before any handler runs, and every update is a Join click on a
+flip (chat, 1) that does not exist, from a distinct user. The handlers
+have little to do, and their replies to Telegram fail for the made up
+chats and users, which the bot logs and ignores. For handler throughput
+see benchmarks/handlers.py.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+def join_update(update_id, chat_id, user_id):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(chat_id),
+            "data": f"join_{chat_id}_1",
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "message": {
+                "message_id": 2,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group"},
+            },
+        },
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--joins", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--secret", default=None)
+    args = parser.parse_args()
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, failures = [], 0
+
+    async with httpx.AsyncClient(headers=headers, limits=httpx.Limits(max_connections=args.concurrency)) as client:
+
+        async def post(i):
+            nonlocal failures
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post(args.url, json=join_update(i, -1000 - i % args.chats, 1 + i))
+                latencies.append((time.perf_counter() - start) * 1000)
+                failures += response.status_code != 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(i) for i in range(args.joins)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{args.joins} updates in {elapsed:.2f}s ({args.joins / elapsed:.0f}/s), {failures} failed")
+    print(
+        f"p50 {statistics.median(latencies):.1f} ms, "
+        f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.1f} ms, max {latencies[-1]:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,166 @@
+"""Async JSON-RPC client for bitcoind.
+
+Keeps HTTP connections to bitcoind alive between calls, caps the number of
+requests in flight and supports JSON-RPC batches, so handlers can await RPC
+results without blocking the event loop:
+
+    rpc = bitcoin_rpc.get_rpc()
+    address = await rpc.getnewaddress("user_1")
+    infos = await rpc.batch([("getaddressinfo", [a]) for a in addresses])
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+from decimal import Decimal
+
+import httpx
+
+import config
+import metrics
+from structured_log import event
+
+
+class RPCError(Exception):
+    """Error returned by bitcoind for a JSON-RPC call"""
+
+    def __init__(self, code, message, method=None):
+        super().__init__(f"{method or 'rpc'} failed ({code}): {message}")
+        self.code = code
+        self.message = message
+        self.method = method
+
+
+def _encode_decimal(o):
+    if isinstance(o, Decimal):
+        return float(o)
+    raise TypeError(f"{o!r} is not JSON serializable")
+
+
+RPC_SECONDS = metrics.Histogram("rpc_call_seconds", "bitcoind RPC round trips", ["method"])
+RPC_ERRORS = metrics.Counter("rpc_errors_total", "RPC calls bitcoind answered with an error", ["method"])
+
+
+class BitcoinRPC:
+    def __init__(
+        self,
+        url,
+        user,
+        password,
+        timeout=30,
+        max_concurrency=8,
+        max_keepalive=4,
+    ):
+        self.url = url
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = httpx.AsyncClient(
+            auth=(user, password),
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_keepalive,
+            ),
+        )
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        async def call(*params, timeout=None):
+            return await self.call(method, *params, timeout=timeout)
+
+        return call
+
+    async def _post(self, payload, timeout, method):
+        body = json.dumps(payload, default=_encode_decimal)
+        async with self._semaphore:
+            with RPC_SECONDS.time(method=method):
+                response = await self._client.post(
+                    self.url,
+                    content=body,
+                    headers={"Content-Type": "application/json"},
+                    timeout=self.timeout if timeout is None else timeout,
+                )
+        # bitcoind answers failed calls with HTTP 500 and a JSON error body
+        if response.status_code != 200 and not response.content:
+            response.raise_for_status()
+        return json.loads(response.content, parse_float=Decimal)
+
+    async def call(self, method, *params, timeout=None):
+        """Runs a single RPC and returns its result, raising RPCError on failure."""
+        reply = await self._post(
+            {"jsonrpc": "1.0", "id": next(self._ids), "method": method, "params": list(params)},
+            timeout,
+            method,
+        )
+        if reply.get("error"):
+            RPC_ERRORS.inc(method=method)
+            raise RPCError(reply["error"].get("code"), reply["error"].get("message"), method)
+        return reply["result"]
+
+    async def batch(self, calls, timeout=None, raise_errors=True):
+        """Runs [(method, params), ...] in one HTTP request.
+
+        Results come back in the order of `calls`. A failed call raises
+        RPCError, or is returned as an RPCError instance with
+        raise_errors=False.
+        """
+        calls = list(calls)
+        if not calls:
+            return []
+        first_id = next(self._ids)
+        payload = [
+            {"jsonrpc": "1.0", "id": first_id + i, "method": method, "params": list(params)}
+            for i, (method, params) in enumerate(calls)
+        ]
+        # Keep the id counter ahead of the ids used in this batch
+        self._ids = itertools.count(first_id + len(calls))
+        replies = await self._post(payload, timeout, "batch")
+        if isinstance(replies, dict):  # the whole batch was rejected
+            RPC_ERRORS.inc(method="batch")
+            error = replies.get("error") or {}
+            raise RPCError(error.get("code"), error.get("message"), "batch")
+
+        results = [None] * len(calls)
+        for reply in replies:
+            i = reply["id"] - first_id
+            if reply.get("error"):
+                RPC_ERRORS.inc(method=calls[i][0])
+                error = RPCError(reply["error"].get("code"), reply["error"].get("message"), calls[i][0])
+                if raise_errors:
+                    raise error
+                results[i] = error
+            else:
+                results[i] = reply["result"]
+        return results
+
+    async def close(self):
+        await self._client.aclose()
+
+
+_rpc = None
+
+
+def get_rpc():
+    """Process-wide client built from config, created on first use."""
+    global _rpc
+    if _rpc is None:
+        _rpc = BitcoinRPC(
+            f"http://{config.RPC_HOST}:{config.RPC_PORT}",
+            config.RPC_USER,
+            config.RPC_PASSWORD,
+            timeout=config.RPC_TIMEOUT,
+            max_concurrency=config.RPC_MAX_CONCURRENCY,
+        )
+        logging.info("bitcoind RPC client for %s ready", _rpc.url, extra=event("rpc_ready", url=_rpc.url))
+    return _rpc
+
+
+async def close_rpc():
+    global _rpc
+    if _rpc is not None:
+        await _rpc.close()
+        _rpc = None
@@ -0,0 +1,42 @@
+"""Entry point of the bot and the deposit checker:
+
+    python cli.py run-bot [--config FILE]
+    python cli.py run-deposits [--config FILE]
+
+Only the modules of the process being started are imported, and nothing
+depends on the working directory. Settings are loaded as described in
+config.py, --config naming the file instead of COINFLIPPER_CONFIG.
+"""
+
+import argparse
+import os
+
+
+def run_bot():
+    import coinflipper
+
+    coinflipper.main()
+
+
+def run_deposits():
+    import deposit_checker
+
+    deposit_checker.run()
+
+
+COMMANDS = {"run-bot": run_bot, "run-deposits": run_deposits}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="coinflipper")
+    parser.add_argument("command", choices=COMMANDS)
+    parser.add_argument("--config", help="file of COINFLIPPER_* settings, by default coinflipper.env")
+    args = parser.parse_args(argv)
+    if args.config:
+        # Before config.py is imported, and inherited by shard workers
+        os.environ["COINFLIPPER_CONFIG"] = os.path.abspath(args.config)
+    COMMANDS[args.command]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Coin selection for withdrawal batches.
+
+UtxoIndex keeps the wallet's spendable outputs sorted by value. It is
+seeded from listunspent, then updated incrementally: the deposit scanner
+adds received outputs that listunspent still has, and the withdrawal
+engine removes what it spends and adds its change.
+
+select_coins() first runs branch and bound over effective values (value
+minus the fee to spend the input) looking for an input set that pays the
+target without a change output, wasting at most the cost of creating and
+later spending change. Failing that it takes the smallest single UTXO
+that covers the target plus change, or else the largest UTXOs first.
+"""
+
+import bisect
+from collections import namedtuple
+
+# Virtual sizes of P2WPKH pieces, which is what the wallet hands out
+INPUT_VBYTES = 68
+OUTPUT_VBYTES = 31
+TX_OVERHEAD_VBYTES = 11
+# Fee rate assumed for spending a change output later
+LONG_TERM_FEE_RATE = 5
+BNB_MAX_TRIES = 100_000
+# Branch and bound only looks at this many of the largest candidates
+# below the target, which keeps its setup cost flat on dust-heavy wallets
+BNB_MAX_CANDIDATES = 2_000
+
+Selection = namedtuple("Selection", "outpoints total fee change algorithm")
+
+
+class InsufficientFunds(Exception):
+    pass
+
+
+class UtxoIndex:
+    def __init__(self):
+        self.values = {}  # (txid, vout) -> sats
+        self.by_value = []  # sorted [(sats, txid, vout)]
+
+    def __len__(self):
+        return len(self.values)
+
+    def total(self):
+        return sum(self.values.values())
+
+    def add(self, txid, vout, sats):
+        if (txid, vout) in self.values:
+            return
+        self.values[(txid, vout)] = sats
+        bisect.insort(self.by_value, (sats, txid, vout))
+
+    def remove(self, txid, vout):
+        sats = self.values.pop((txid, vout), None)
+        if sats is None:
+            return
+        i = bisect.bisect_left(self.by_value, (sats, txid, vout))
+        del self.by_value[i]
+
+    def replace_all(self, utxos):
+        """Rebuilds the index from [(txid, vout, sats), ...]"""
+        self.values = {(txid, vout): sats for txid, vout, sats in utxos}
+        self.by_value = sorted((sats, txid, vout) for (txid, vout), sats in self.values.items())
+
+
+async def load_utxos(rpc, index):
+    """Rebuilds the index from the wallet's confirmed UTXOs"""
+    utxos = await rpc.listunspent(1)
+    index.replace_all(
+        (u["txid"], u["vout"], int(u["amount"] * 100_000_000))
+        for u in utxos
+        if u.get("spendable", True)
+    )
+
+
+async def add_unspent(rpc, index, received):
+    """Adds the received outputs (listsinceblock entries) that are confirmed
+    and not yet spent, asking listunspent about their addresses only"""
+    wanted = {(tx["txid"], tx["vout"]) for tx in received} - index.values.keys()
+    if not wanted:
+        return
+    addresses = sorted({tx["address"] for tx in received if (tx["txid"], tx["vout"]) in wanted})
+    for u in await rpc.listunspent(1, 9_999_999, addresses):
+        if (u["txid"], u["vout"]) in wanted and u.get("spendable", True):
+            index.add(u["txid"], u["vout"], int(u["amount"] * 100_000_000))
+
+
+def _branch_and_bound(values, target, tolerance):
+    """Indices into values (descending) summing to [target, target + tolerance], or None"""
+    remaining = [0] * (len(values) + 1)
+    for i in range(len(values) - 1, -1, -1):
+        remaining[i] = remaining[i + 1] + values[i]
+    if remaining[0] < target:
+        return None
+
+    best, best_waste = None, None
+    selected, total, depth = [], 0, 0
+    for _ in range(BNB_MAX_TRIES):
+        backtrack = False
+        if total + remaining[depth] < target or total > target + tolerance:
+            backtrack = True
+        elif total >= target:
+            waste = total - target
+            if best_waste is None or waste < best_waste:
+                best, best_waste = list(selected), waste
+                if waste == 0:
+                    break
+            backtrack = True
+
+        if backtrack:
+            # Drop the most recent inclusion and explore the branch without it
+            if not selected:
+                break
+            last = selected.pop()
+            total -= values[last]
+            depth = last + 1
+        else:
+            selected.append(depth)
+            total += values[depth]
+            depth += 1
+    return best
+
+
+def select_coins(index, amount, fee_rate, n_outputs=1):
+    """Picks inputs paying `amount` sats to n_outputs outputs at fee_rate sat/vB"""
+    input_fee = fee_rate * INPUT_VBYTES
+    base_fee = fee_rate * (TX_OVERHEAD_VBYTES + n_outputs * OUTPUT_VBYTES)
+    change_fee = fee_rate * OUTPUT_VBYTES
+    cost_of_change = change_fee + LONG_TERM_FEE_RATE * INPUT_VBYTES
+    target = amount + base_fee
+
+    # Changeless solutions can only use inputs worth less than the upper bound
+    by_value = index.by_value
+    upper = bisect.bisect_right(by_value, (target + cost_of_change + input_fee + 1,))
+    lower = max(0, upper - BNB_MAX_CANDIDATES)
+    candidates = [u for u in reversed(by_value[lower:upper]) if u[0] > input_fee]
+    found = _branch_and_bound([u[0] - input_fee for u in candidates], target, cost_of_change)
+    if found is not None:
+        chosen = [candidates[i] for i in found]
+        total = sum(u[0] for u in chosen)
+        return Selection([(u[1], u[2]) for u in chosen], total, total - amount, 0, "bnb")
+
+    # With change: the smallest single UTXO that covers everything
+    with_change = target + change_fee + input_fee
+    i = bisect.bisect_left(by_value, (with_change,))
+    if i < len(by_value):
+        u = by_value[i]
+        fee = base_fee + change_fee + input_fee
+        return Selection([(u[1], u[2])], u[0], fee, u[0] - amount - fee, "single")
+
+    # Otherwise the largest UTXOs until the target is met
+    chosen, total, fee = [], 0, base_fee + change_fee
+    for u in reversed(by_value):
+        if u[0] <= input_fee:
+            break
+        chosen.append(u)
+        total += u[0]
+        fee += input_fee
+        if total >= amount + fee:
+            return Selection([(c[1], c[2]) for c in chosen], total, fee, total - amount - fee, "largest_first")
+    raise InsufficientFunds(f"Need {amount} sats plus fees, the wallet has {index.total()} spendable")
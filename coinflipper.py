@@ -1,43 +1,234 @@
 #!/usr/bin/python3
 
-import asyncpg
+import asyncio
+import contextlib
+import functools
 import logging
+import math
+import os
 import random
-from bitcoinrpc.authproxy import AuthServiceProxy
-from bitcoinrpc.authproxy import JSONRPCException
-from decimal import Decimal
+import signal
+import time
 from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update
+from telegram.error import Forbidden, TelegramError
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    ApplicationHandlerStop,
     CallbackContext,
+    TypeHandler,
 )
 
+import address_pool
+import config
+import db
+import fair_random
+import flip_store
+import ledger
+import metrics
+import player_stats
+import sharding
+import structured_log
+from balance_cache import BalanceCache, BALANCE_CHANNEL, MISSING
+from flip_expiry import FlipExpiry
+from flip_message import FlipMessage, participant_pages
+from rate_limit import RateLimiter, update_command
+from edit_scheduler import EditScheduler, TELEGRAM_ERRORS
+from settlement import settle_flip
+from trivia_store import TriviaStore
+import withdrawals
+from bitcoin_rpc import get_rpc, close_rpc
+from structured_log import event
+
+# JSON lines, rotated at LOG_MAX_BYTES or every LOG_ROTATE_WHEN if set
 LOG_FILE = "/var/log/coinflipper.log"
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
+LOG_MAX_BYTES = 50_000_000
+LOG_BACKUPS = 5
+LOG_ROTATE_WHEN = None
+# Keep one in N records of these high volume events
+LOG_SAMPLE_RATES = {"join_attempt": 10, "balance_checked": 10, "throttled": 10}
+
+# "memory" keeps open flips in this process, "postgres" keeps them in the
+# database so they survive restarts and can be shared by several workers
+FLIP_STORE = "memory"
+flips = flip_store.MemoryFlipStore()
+
+# Open flips are cancelled after FLIP_TTL, or after the chat's entry in
+# CHAT_FLIP_TTLS ({chat_id: timedelta}).
+FLIP_TTL = timedelta(days=1)
+CHAT_FLIP_TTLS = {}
+SWEEP_INTERVAL = 60  # seconds between expiry sweeps
+expiry = FlipExpiry(FLIP_TTL, CHAT_FLIP_TTLS)
+
+# Flip message edits go through the edit scheduler: participant updates to
+# one message are coalesced over EDIT_DEBOUNCE seconds, each chat gets one
+# edit per EDIT_CHAT_INTERVAL and the bot at most EDIT_GLOBAL_RATE per second.
+EDIT_DEBOUNCE = 0.5
+EDIT_CHAT_INTERVAL = 3.0
+EDIT_GLOBAL_RATE = 25
+edits = None  # EditScheduler, created on startup
+
+BALANCE_CACHE_SIZE = 10_000
+BALANCE_CACHE_TTL = 30  # seconds, bounds staleness if a notification is lost
+balances = BalanceCache(BALANCE_CACHE_SIZE, BALANCE_CACHE_TTL)
+balance_listener = None  # connection receiving balance NOTIFYs from other processes
+
+MIN_WITHDRAWAL_SATS = 1000  # smaller outputs are dust and would sink a whole batch
+MAX_FEE_RATE = 500  # sat/vB a withdrawal may ask for, see withdrawals.check_fee_rate()
+MAX_ADDRESSES = 100  # deposit addresses per user
+
+STATS_CACHE_TTL = 30  # seconds /stats and /top answers are reused for
+stats_cache = player_stats.StatsCache(STATS_CACHE_TTL)
+
+TRIVIA_FILE = "trivia.txt"  # relative to this directory unless absolute
+trivia_facts = TriviaStore(config.path(TRIVIA_FILE))
+
+# Token buckets checked before any handler runs, see rate_limit.py:
+# command or callback prefix -> [(scope, per minute, burst)], scope "user"
+# or "chat". Commands not listed get RATE_LIMIT_DEFAULT. Throttled callbacks
+# are answered, throttled commands get at most one reply per
+# RATE_LIMIT_NOTICE_INTERVAL seconds.
+RATE_LIMITS = {
+    "coinflip": [("user", 6, 3), ("chat", 30, 10)],
+    "giveflip": [("user", 6, 3), ("chat", 30, 10)],
+    "join": [("user", 60, 5)],
+    "cancel": [("user", 30, 5)],
+    "show": [("user", 2, 2)],
+    "address": [("user", 2, 2)],
+    "withdraw": [("user", 3, 2)],
+    "history": [("user", 20, 5)],
+    "stats": [("user", 10, 3)],
+    "top": [("user", 10, 3), ("chat", 20, 5)],
+}
+RATE_LIMIT_DEFAULT = [("user", 30, 10)]
+RATE_LIMIT_BUCKETS = 1_000_000
+RATE_LIMIT_NOTICE_INTERVAL = 30
+limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_DEFAULT, RATE_LIMIT_BUCKETS)
+notices = RateLimiter({}, [("user", 60 / RATE_LIMIT_NOTICE_INTERVAL, 1)], RATE_LIMIT_BUCKETS)
+
+# Webhook mode when WEBHOOK_URL is set, long polling otherwise. TLS is
+# expected to be terminated by a reverse proxy forwarding to WEBHOOK_LISTEN.
+WEBHOOK_URL = None  # e.g. "https://bot.example.com/telegram"
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+WEBHOOK_SECRET = None  # checked against X-Telegram-Bot-Api-Secret-Token
+# Updates handled at once. Joins on the same flip are still serialised by
+# flip_locks, everything else runs concurrently.
+CONCURRENT_UPDATES = 256
+
+# With SHARDS > 1 this process only receives updates and routes them by
+# chat to SHARDS worker processes, see sharding.py. Each worker logs to
+# LOG_FILE with its number appended and serves metrics on METRICS_PORT + 1
+# + its number, the supervisor keeps LOG_FILE and METRICS_PORT.
+SHARDS = 1
+shard = None  # (index, shards) in a worker process
+
+flip_locks = {}  # (chat_id, msg_id) -> [asyncio.Lock, handlers using it]
+renders = {}  # (chat_id, msg_id) -> FlipMessage of open flips
+
+# GET /metrics on METRICS_HOST:METRICS_PORT, None disables it
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9101
+metrics_server = None
+
+OPEN_FLIPS = metrics.Gauge("open_flips", "Flips waiting for players in this process")
+OPEN_FLIPS.set_function(lambda: expiry.stats()["live"])
+FLIPS_EXPIRED = metrics.Gauge("flips_expired", "Flips cancelled by timeout since startup")
+FLIPS_EXPIRED.set_function(lambda: expiry.expired)
+FLIP_LOCKS = metrics.Gauge("flip_locks", "Flips with handlers holding or waiting for their lock")
+FLIP_LOCKS.set_function(lambda: len(flip_locks))
+EDITS_PENDING = metrics.Gauge("edits_pending", "Message edits queued in the edit scheduler")
+EDITS_PENDING.set_function(lambda: len(edits.pending) if edits is not None else 0)
+BALANCE_CACHE = metrics.Gauge("balance_cache", "Balance cache size and counters", ["stat"])
+BALANCE_CACHE.set_function(lambda: {(k,): v for k, v in balances.stats().items()})
+RATE_LIMITER = metrics.Gauge("rate_limiter", "Rate limiter buckets and counters", ["stat"])
+RATE_LIMITER.set_function(lambda: {(k,): v for k, v in limiter.stats().items()})
+ADDRESS_POOL_EMPTY = metrics.Counter(
+    "address_pool_empty_total", "/address calls that found the address pool empty"
 )
-logging.getLogger("httpx").setLevel(logging.WARNING)
-logging.getLogger("telegram").setLevel(logging.WARNING)
+THROTTLED = metrics.Counter("throttled_total", "Updates dropped by the rate limiter", ["command"])
+SETTLEMENT_SECONDS = metrics.Histogram("settlement_seconds", "Time to settle a full flip", ["result"])
+SETTLEMENT_PARTICIPANTS = metrics.Histogram(
+    "settlement_participants", "Participants per settled flip", buckets=(2, 3, 5, 10, 20, 50, 100, 250, 1000)
+)
+SETTLEMENT_SATS = metrics.Histogram(
+    "settlement_sats", "Prize per settled flip in sats", buckets=tuple(10**i for i in range(2, 10))
+)
+
+
+@contextlib.asynccontextmanager
+async def locked_flip(key):
+    """Serialises handlers working on the same flip"""
+    entry = flip_locks.get(key)
+    if entry is None:
+        entry = flip_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del flip_locks[key]
 
-RPC_USER = "rpcuser"
-RPC_PASSWORD = "123"
-RPC_HOST = "127.0.0.1"
-RPC_PORT = 8332
 
-DB_HOST = "127.0.0.1"
-DB_NAME = "coinflipper"
-DB_USER = "botuser"
-DB_PASSWORD = "123"
+def per_flip(handler):
+    """Runs a join_/cancel_ callback handler under its flip's lock"""
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext):
+        _, chat_id, msg_id = update.callback_query.data.split("_")
+        async with locked_flip((int(chat_id), int(msg_id))):
+            return await handler(update, context)
+
+    return wrapper
+
+
+def flip_message(key, flip):
+    """The flip's cached FlipMessage, brought up to date with its participants"""
+    rendered = renders.get(key)
+    if rendered is None:
+        # Flips loaded from the Postgres store after a restart
+        seed = flip.get("seed")
+        rendered = renders[key] = FlipMessage(key, flip, fair_random.commitment(seed) if seed else None)
+    else:
+        rendered.sync(flip["participants"])
+    return rendered
 
-flips = {}
 
-with open('trivia.txt', 'r') as f:
-    TRIVIA = f.read().splitlines()
+def forget_flip(key):
+    """Drops what this process keeps about a flip that was taken from the store"""
+    expiry.forget(key)
+    renders.pop(key, None)
+
+
+async def rate_limit(update: Update, context: CallbackContext):
+    """Runs before every other handler and stops updates over their rate limit"""
+    command = update_command(update)
+    user = update.effective_user
+    if command is None or user is None:
+        return
+    chat_id = update.effective_chat.id if update.effective_chat is not None else user.id
+    wait = limiter.check(command, user.id, chat_id)
+    if wait is None:
+        return
+
+    THROTTLED.inc(command=command)
+    logging.info(
+        "User %s throttled on %s in chat %s for %.1fs", user.id, command, chat_id, wait,
+        extra=event("throttled", user_id=user.id, chat_id=chat_id, command=command, wait=round(wait, 1)),
+    )
+    text = f"⏳ Slow down, try again in {math.ceil(wait)}s."
+    if update.callback_query is not None:
+        await update.callback_query.answer(text)
+    elif notices.check("notice", user.id, chat_id) is None:
+        await update.effective_message.reply_text(text)
+    raise ApplicationHandlerStop
+
 
 async def giveflip(update: Update, context: CallbackContext):
     await flip(update, context, True)
@@ -60,181 +251,228 @@ async def flip(update: Update, context: CallbackContext, is_giveflip: bool):
     message = update.message
 
     logging.info(
-        f"User {user_id} ({username}) initiated {'giveflip' if is_giveflip else 'coinflip'}: entry={sats} sats, n_participants={n_participants} in chat {chat_id}."
+        "User %s (%s) initiated %s: entry=%s sats, n_participants=%s in chat %s",
+        user_id, username, "giveflip" if is_giveflip else "coinflip", sats, n_participants, chat_id,
+        extra=event("flip_requested", user_id=user_id, chat_id=chat_id, sats=sats, max=n_participants),
     )
 
     if n_participants < 1 + int(not is_giveflip):
         await update.message.reply_text(f"Need >={1 + int(not is_giveflip)} participants.")
         return
 
-    conn = await get_db_connection()
-    balance = await conn.fetchval(
-        "SELECT balance FROM balances WHERE user_id = $1", user_id
-    )
-    await conn.close()
+    balance = await get_user_balance(user_id)
 
     if balance is None or balance < sats:
         logging.info(
-            f"User {user_id} ({username}) has insufficient balance ({balance}) for {'giveflip' if is_giveflip else 'coinflip'} entry of {sats} sats."
+            "User %s (%s) has insufficient balance (%s) for %s entry of %s sats",
+            user_id, username, balance, "giveflip" if is_giveflip else "coinflip", sats,
+            extra=event("insufficient_balance", user_id=user_id, chat_id=chat_id, sats=sats, balance=balance),
         )
         await update.message.reply_text(
             "You don't have enough balance to start this flip."
         )
         return
 
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                "Join", callback_data=f"join_{chat_id}_{message.message_id}"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "Cancel", callback_data=f"cancel_{chat_id}_{message.message_id}"
-            )
-        ],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    msg = await update.message.reply_text(
-        f"{'🎁 Giveflip' if is_giveflip else '🎲 Coinflip'} started! {sats} sats {'given' if is_giveflip else 'entry'}. {n_participants} player{'s' if n_participants > 1 else ''} needed.",
-        reply_markup=reply_markup,
-    )
-
-    flips[(chat_id, message.message_id)] = {
+    key = (chat_id, message.message_id)
+    seed = fair_random.new_seed()
+    new_flip = {
         "creator": user_id,
         "sats": sats,
         "max": n_participants,
         "participants": [],
         "start_time": datetime.utcnow(),
         "is_giveflip": is_giveflip,
+        "seed": seed,
     }
+    rendered = FlipMessage(key, new_flip, fair_random.commitment(seed))
+    msg = await update.message.reply_text(rendered.text(), reply_markup=rendered.reply_markup)
+
+    new_flip["announcement_id"] = msg.message_id
+    await flips.create(key, new_flip)
+    renders[key] = rendered
+    expiry.track(key, new_flip["start_time"])
 
     logging.info(
-        f"{'Giveflip' if is_giveflip else 'Coinflip'} created by user {user_id} ({username}) with message_id {msg.message_id} in chat {chat_id}."
+        "%s created by user %s (%s) with message_id %s in chat %s",
+        "Giveflip" if is_giveflip else "Coinflip", user_id, username, msg.message_id, chat_id,
+        extra=event(
+            "flip_created", user_id=user_id, chat_id=chat_id, flip=(chat_id, message.message_id), sats=sats
+        ),
     )
 
 
+@per_flip
 async def join_coinflip(update: Update, context: CallbackContext):
+    started = time.perf_counter()
     query = update.callback_query
     _, chat_id, msg_id = query.data.split("_")
     chat_id, msg_id = int(chat_id), int(msg_id)
     user_id = query.from_user.id
     username = query.from_user.username or query.from_user.full_name
+    fields = {"user_id": user_id, "chat_id": chat_id, "flip": (chat_id, msg_id)}
 
     logging.info(
-        f"User {user_id} ({username}) attempting to join flip in chat {chat_id}, message {msg_id}."
+        "User %s (%s) attempting to join flip in chat %s, message %s",
+        user_id, username, chat_id, msg_id,
+        extra=event("join_attempt", **fields),
     )
 
-    if (chat_id, msg_id) not in flips:
+    flip = await flips.get((chat_id, msg_id))
+    if flip is None:
         logging.warning(
-            f"User {user_id} ({username}) attempted to join a non-existent flip in chat {chat_id}, message {msg_id}."
+            "User %s (%s) attempted to join a non-existent flip in chat %s, message %s",
+            user_id, username, chat_id, msg_id,
+            extra=event("join_missing", **fields),
         )
         await query.answer("This flip no longer exists.")
         return
 
-    flip = flips[(chat_id, msg_id)]
-
-    if datetime.utcnow() - flip["start_time"] > timedelta(days=1):
+    if expiry.is_expired((chat_id, msg_id), flip["start_time"], datetime.utcnow()):
         logging.info(
-            f"Coinflip in chat {chat_id}, message {msg_id} timed out. Cancelling flip."
-        )
-        del flips[(chat_id, msg_id)]
-        await context.bot.edit_message_text(
-            chat_id=chat_id, message_id=msg_id, text="Flip cancelled due to timeout."
+            "Flip in chat %s, message %s timed out, cancelling it", chat_id, msg_id,
+            extra=event("flip_timeout", chat_id=chat_id, flip=(chat_id, msg_id)),
         )
+        if await flips.take((chat_id, msg_id)) is not None:
+            forget_flip((chat_id, msg_id))
+            expiry.expired += 1
+            edits.schedule(chat_id, flip["announcement_id"], "Flip cancelled due to timeout.", final=True)
+        await query.answer("This flip timed out and was cancelled.")
         return
 
     if user_id in [p[0] for p in flip["participants"]]:
         logging.info(
-            f"User {user_id} ({username}) already joined flip in chat {chat_id}, message {msg_id}."
+            "User %s (%s) already joined flip in chat %s, message %s",
+            user_id, username, chat_id, msg_id,
+            extra=event("join_rejected", status="already", **fields),
         )
         await query.answer("You have already joined.")
         return
 
-    conn = await get_db_connection()
-    balance = await conn.fetchval(
-        "SELECT balance FROM balances WHERE user_id = $1", user_id
-    )
-    await conn.close()
+    balance = await get_user_balance(user_id)
     if balance is None:
-        await conn.execute(
-            "INSERT INTO balances (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING",
-            user_id,
-        )
+        async with db.acquire() as conn:
+            balance = await conn.fetchval(
+                "INSERT INTO balances (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING RETURNING balance",
+                user_id,
+            ) or 0
+        balances.invalidate(user_id)
         logging.info(
-            f"User {user_id} ({username}) tried to join a flip without an account."
+            "User %s (%s) tried to join a flip without an account", user_id, username,
+            extra=event("account_created", **fields),
         )
 
     if balance < flip["sats"] and not flip['is_giveflip']:
         logging.info(
-            f"User {user_id} ({username}) has insufficient balance ({balance}) to join coinflip requiring {flip['sats']} sats."
+            "User %s (%s) has insufficient balance (%s) to join coinflip requiring %s sats",
+            user_id, username, balance, flip["sats"],
+            extra=event("insufficient_balance", sats=flip["sats"], balance=balance, **fields),
         )
         await query.answer("You don't have enough balance.")
         return
 
-    flip["participants"].append((user_id, username))
+    status, flip = await flips.join((chat_id, msg_id), user_id, username)
+    if status != "joined":
+        logging.info(
+            "User %s (%s) could not join flip in chat %s, message %s: %s",
+            user_id, username, chat_id, msg_id, status,
+            extra=event("join_rejected", status=status, **fields),
+        )
+        await query.answer({
+            "missing": "This flip no longer exists.",
+            "already": "You have already joined.",
+            "full": "This flip is full.",
+        }[status])
+        return
     logging.info(
-        f"User {user_id} ({username}) successfully joined flip in chat {chat_id}, message {msg_id}. Total participants: {len(flip['participants'])}."
+        "User %s (%s) joined flip in chat %s, message %s, %s participants",
+        user_id, username, chat_id, msg_id, len(flip["participants"]),
+        extra=event(
+            "join",
+            sats=flip["sats"],
+            participants=len(flip["participants"]),
+            latency_ms=round((time.perf_counter() - started) * 1000, 2),
+            **fields,
+        ),
     )
 
-    participant_list = "\n".join([p[1] for p in flip["participants"]])
-    keyboard = [
-        [InlineKeyboardButton("Join", callback_data=f"join_{chat_id}_{msg_id}")],
-        [InlineKeyboardButton("Cancel", callback_data=f"cancel_{chat_id}_{msg_id}")],
-    ]
-    await query.edit_message_text(
-        text=f"{'🎁 Giveflip' if flip['is_giveflip'] else '🎲 Coinflip'} started! {flip['sats']} sats {'given' if flip['is_giveflip'] else 'entry'}. {flip['max']} players needed.\n\nParticipants:\n{participant_list}",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-    )
+    rendered = flip_message((chat_id, msg_id), flip)
+    # Flips created before seeds were stored have no published commitment
+    seed = flip.get("seed")
+    commitment = f"\n\n🔒 Commitment: {fair_random.commitment(seed)}" if seed else ""
+    await query.answer()
+    edits.schedule(chat_id, flip["announcement_id"], rendered.text(), rendered.reply_markup)
 
     if len(flip["participants"]) >= flip["max"]:
         logging.info(
-            f"{'Giveflip' if flip['is_giveflip'] else 'Coinflip'} in chat {chat_id}, message {msg_id} reached max participants. Determining winner..."
+            "Flip in chat %s, message %s reached max participants, determining winner", chat_id, msg_id,
+            extra=event("flip_full", chat_id=chat_id, flip=(chat_id, msg_id), sats=flip["sats"]),
         )
-        if flip['is_giveflip']:
-            balance = await get_user_balance(flip['creator'])
-            if balance < flip["sats"]:
-                logging.warning(f"Giver {flip['creator']} lacks funds")
-                await query.edit_message_text(text=f"😳 Giver lacks balance to giveflip")
-                return
-        else:
-            for user in flip["participants"]:
-                user_id = user[0]
-                balance = await get_user_balance(user_id)
-                if balance < flip["sats"]:
-                    logging.warning(f"Some participants lack funds")
-                    await query.edit_message_text(text=f"😳 Users lack balance to coinflip")
-                    return
-
-            logging.info(f"All participants have sufficient balance. Determining winner...")
-        winner_id, winner_name = random.choice(flip["participants"])
+        # Only the worker that removes the flip from the store settles it
+        if await flips.take((chat_id, msg_id)) is None:
+            return
+        forget_flip((chat_id, msg_id))
+        seed = flip["seed"] = seed or fair_random.new_seed()
+        winner_id = fair_random.draw_winners(seed, [p[0] for p in flip["participants"]])[0]
+        winner_name = dict(flip["participants"])[winner_id]
         total_prize = flip['sats'] if flip['is_giveflip'] else (flip["sats"] * (flip["max"] - 1))
 
-        conn = await get_db_connection()
-        async with conn.transaction():
+        settle_started = time.perf_counter()
+        try:
+            async with db.acquire() as conn:
+                short, new_balances = await settle_flip(conn, flip, winner_id, (chat_id, msg_id), balance_notify())
+        except Exception as e:
+            # The flip is already out of the store, close it rather than leave a dead Join button
+            SETTLEMENT_SECONDS.observe(time.perf_counter() - settle_started, result="error")
+            logging.error(
+                "Settling flip in chat %s, message %s failed: %s", chat_id, msg_id, e,
+                extra=event("settle_failed", chat_id=chat_id, flip=(chat_id, msg_id), error=type(e).__name__),
+            )
+            edits.schedule(
+                chat_id, flip["announcement_id"], "⚠️ Settlement failed, flip cancelled.", final=True
+            )
+            return
+        settle_seconds = time.perf_counter() - settle_started
+        settle_ms = round(settle_seconds * 1000, 2)
+        SETTLEMENT_SECONDS.observe(settle_seconds, result="short" if short else "settled")
+        for uid, new_balance in new_balances.items():
+            balances.set(uid, new_balance)
+        if short:
             if flip['is_giveflip']:
-                await conn.execute(
-                    "UPDATE balances SET balance = balance - $1 WHERE user_id = $2",
-                    flip["sats"],
-                    flip['creator'],
+                logging.warning(
+                    "Giver %s lacks funds", flip["creator"],
+                    extra=event("settle_short", chat_id=chat_id, flip=(chat_id, msg_id), short=short),
                 )
+                edits.schedule(chat_id, flip["announcement_id"], "😳 Giver lacks balance to giveflip", final=True)
             else:
-                for participant_id, _ in flip["participants"]:
-                    if participant_id != winner_id:
-                        await conn.execute(
-                            "UPDATE balances SET balance = balance - $1 WHERE user_id = $2",
-                            flip["sats"],
-                            participant_id,
-                        )
-            await conn.execute(
-                "UPDATE balances SET balance = balance + $1 WHERE user_id = $2",
-                total_prize,
-                winner_id,
-            )
-        await conn.close()
+                names = [name for uid, name in flip["participants"] if uid in short]
+                logging.warning(
+                    "Participants %s lack funds", short,
+                    extra=event("settle_short", chat_id=chat_id, flip=(chat_id, msg_id), short=short),
+                )
+                edits.schedule(
+                    chat_id,
+                    flip["announcement_id"],
+                    f"😳 Users lack balance to coinflip: {', '.join(names)}",
+                    final=True,
+                )
+            return
 
+        SETTLEMENT_PARTICIPANTS.observe(len(flip["participants"]))
+        SETTLEMENT_SATS.observe(total_prize)
         logging.info(
-            f"{'Giveflip' if flip['is_giveflip'] else 'Coinflip'} in chat {chat_id}, message {msg_id}: Winner is user {winner_id} ({winner_name}) winning {total_prize} sats."
+            "%s in chat %s, message %s: winner is user %s (%s) winning %s sats",
+            "Giveflip" if flip["is_giveflip"] else "Coinflip", chat_id, msg_id, winner_id, winner_name, total_prize,
+            extra=event(
+                "flip_settled",
+                user_id=winner_id,
+                chat_id=chat_id,
+                flip=(chat_id, msg_id),
+                sats=total_prize,
+                seed=seed.hex(),
+                commitment=fair_random.commitment(seed),
+                participants=[p[0] for p in flip["participants"]],
+                latency_ms=settle_ms,
+            ),
         )
         emoji = random.choice([
             "🔥", "🎉", "🥂", "💹", "🦈", "🗽", "🏆", "🏅", "🥇", "💰", "💎", "🎖️", "🚀", "⚡",
@@ -246,52 +484,106 @@ async def join_coinflip(update: Update, context: CallbackContext):
             "🌞", "🌅", "🌄", "🎑", "🚨", "💣", "📯", "🔊", "📢", "📣", "🎙️", "🎚️", "🎛️",
             "🎚️", "📻", "📡", "🛰️", "💈", "🔱", "🏵️", "🧧", "🎗️", "🎟️"
         ])
-        await query.edit_message_text(text=f"{emoji} {winner_name} won the {'giveflip' if flip['is_giveflip'] else 'coinflip'} and received {total_prize} sats!\n\nParticipants:\n{participant_list}",
-                reply_markup=None)
-        del flips[(chat_id, msg_id)]
+        edits.schedule(
+            chat_id,
+            flip["announcement_id"],
+            f"{emoji} {winner_name} won the {'giveflip' if flip['is_giveflip'] else 'coinflip'} and received {total_prize} sats!\n\nParticipants:\n{rendered.participants()}{commitment}\n🔑 Seed: {seed.hex()}",
+            final=True,
+        )
 
 
+@per_flip
 async def cancel_coinflip(update: Update, context: CallbackContext):
     query = update.callback_query
     _, chat_id, msg_id = query.data.split("_")
     chat_id, msg_id = int(chat_id), int(msg_id)
     user_id = query.from_user.id
+    fields = {"user_id": user_id, "chat_id": chat_id, "flip": (chat_id, msg_id)}
 
     logging.info(
-        f"User {user_id} requested cancellation of flip in chat {chat_id}, message {msg_id}."
+        "User %s requested cancellation of flip in chat %s, message %s", user_id, chat_id, msg_id,
+        extra=event("cancel_attempt", **fields),
     )
 
-    if (chat_id, msg_id) not in flips:
+    flip = await flips.get((chat_id, msg_id))
+    if flip is None:
         logging.warning(
-            f"User {user_id} attempted to cancel a non-existent flip in chat {chat_id}, message {msg_id}."
+            "User %s attempted to cancel a non-existent flip in chat %s, message %s", user_id, chat_id, msg_id,
+            extra=event("cancel_missing", **fields),
         )
         await query.answer("This flip no longer exists.")
         return
 
-    flip = flips[(chat_id, msg_id)]
     if user_id != flip["creator"]:
         logging.info(
-            f"User {user_id} is not the creator and cannot cancel flip in chat {chat_id}, message {msg_id}."
+            "User %s is not the creator and cannot cancel flip in chat %s, message %s", user_id, chat_id, msg_id,
+            extra=event("cancel_denied", **fields),
         )
         await query.answer("Only the creator can cancel.")
         return
 
-    del flips[(chat_id, msg_id)]
+    if await flips.take((chat_id, msg_id)) is None:
+        await query.answer("This flip no longer exists.")
+        return
+    forget_flip((chat_id, msg_id))
     logging.info(
-        f"User {user_id} canceled flip in chat {chat_id}, message {msg_id}."
+        "User %s cancelled flip in chat %s, message %s", user_id, chat_id, msg_id,
+        extra=event("flip_cancelled", **fields),
     )
-    await query.edit_message_text(text="Coinflip cancelled 🌠")
+    await query.answer()
+    edits.schedule(chat_id, flip["announcement_id"], "Coinflip cancelled 🌠", final=True)
 
 
-async def get_db_connection():
-    return await asyncpg.connect(
-        host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASSWORD
+async def show_participants(update: Update, context: CallbackContext):
+    """Sends the full participant list of a flip whose message is truncated, in private"""
+    query = update.callback_query
+    _, chat_id, msg_id = query.data.split("_")
+    key = (int(chat_id), int(msg_id))
+    user_id = query.from_user.id
+
+    flip = await flips.get(key)
+    if flip is None:
+        await query.answer("This flip no longer exists.")
+        return
+    names = [name for _, name in flip["participants"]]
+    try:
+        for page in participant_pages([f"👥 {len(names)} participants:"] + names):
+            await context.bot.send_message(chat_id=user_id, text=page)
+    except Forbidden:
+        await query.answer("Start a private chat with me first, then tap again.", show_alert=True)
+        return
+    logging.info(
+        "User %s was sent the %s participants of flip %s", user_id, len(names), key,
+        extra=event("participants_shown", user_id=user_id, chat_id=key[0], flip=key, participants=len(names)),
     )
+    await query.answer("Sent you the list in a private chat.")
+
+
+async def sweep_expired_flips(context: CallbackContext):
+    """Cancels flips past their TTL and closes their messages"""
+    for key in expiry.pop_due(datetime.utcnow()):
+        renders.pop(key, None)
+        flip = await flips.take(key)
+        if flip is None:
+            continue
+        expiry.expired += 1
+        # The edit scheduler paces these within the chat and global limits
+        edits.schedule(key[0], flip["announcement_id"], "Flip cancelled due to timeout.", final=True)
+        logging.info(
+            "Flip in chat %s, message %s timed out, cancelling it", *key,
+            extra=event("flip_timeout", chat_id=key[0], flip=key),
+        )
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(
+            "Flip expiry: %s, edits: %s", expiry.stats(), edits.stats,
+            extra=event("sweep", **expiry.stats(), **edits.stats),
+        )
 
 
 async def trivia(update: Update, context: CallbackContext):
-    trivia_text = random.choice(TRIVIA)
-    await update.message.reply_text(trivia_text, parse_mode="Markdown")
+    await update.message.reply_text(trivia_facts.choice(), parse_mode="Markdown")
+
 
 async def start(update: Update, context: CallbackContext):
     """Handles the /start command by showing available commands."""
@@ -301,7 +593,11 @@ async def start(update: Update, context: CallbackContext):
         "💰 `/balance` – Check your Bitcoin balance\n"
         "🏠 `/address` – Get a new Bitcoin deposit address\n"
         "🏘 `/addresses` – List generated addresses\n"
-        "📤 `/withdraw <address> <amount_in_sats>` – Withdraw Bitcoin to an external address\n"
+        "📤 `/withdraw <address> <amount_in_sats> [fee_rate]` – Withdraw Bitcoin to an external address\n"
+        "📋 `/withdrawals` – Show your recent withdrawals\n"
+        "📜 `/history` – Show your balance history\n"
+        "📊 `/stats` – Show your flip statistics\n"
+        "🏆 `/top [chat|global]` – Show the players who won the most\n"
         "🐬 `/coinflip <sats> <number of participants>` – Start coinflip, winner takes all\n"
         "🎁 `/giveflip <sats> <number of participants>` – Start giveflip, winner takes all\n\n"
         "🔗 *Source Code:* [GitHub Repository](https://github.com/fridokus/coinflipper)\n\n"
@@ -313,37 +609,33 @@ async def start(update: Update, context: CallbackContext):
 
 
 async def address(update: Update, context: CallbackContext):
-    """Handles the /address command by generating a new BTC address if the user has not exceeded the limit."""
+    """Handles the /address command by giving out a BTC address if the user has not exceeded the limit."""
     user_id = update.effective_user.id
-    rpc = AuthServiceProxy(f"http://{RPC_USER}:{RPC_PASSWORD}@{RPC_HOST}:{RPC_PORT}")
 
-    conn = await get_db_connection()
-
-    # Count existing addresses for the user
-    address_count = await conn.fetchval(
-        "SELECT COUNT(*) FROM addresses WHERE user_id = $1", user_id
-    )
-
-    if address_count >= 100:
+    async with db.acquire() as conn:
+        new_address, count = await address_pool.claim(conn, user_id, MAX_ADDRESSES)
+    if new_address is None and count < MAX_ADDRESSES:
+        # The deposit checker has not kept up, generate one on the spot
+        ADDRESS_POOL_EMPTY.inc()
+        logging.warning("Address pool is empty", extra=event("address_pool_empty", user_id=user_id))
+        generated = await get_rpc().getnewaddress(f"user_{user_id}")
+        async with db.acquire() as conn:
+            new_address, count = await address_pool.assign(conn, user_id, generated, MAX_ADDRESSES)
+
+    if new_address is None:
         logging.warning(
-            f"User {user_id} attempted to generate more than 100 addresses."
+            "User %s attempted to generate more than %s addresses", user_id, MAX_ADDRESSES,
+            extra=event("address_limit", user_id=user_id),
         )
         await update.message.reply_text(
-            "You have already generated 100 addresses. Limit reached."
+            f"You have already generated {MAX_ADDRESSES} addresses. Limit reached."
         )
-        await conn.close()
         return
 
-    new_address = rpc.getnewaddress(f"user_{user_id}")
-    await conn.execute(
-        "INSERT INTO balances (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING",
-        user_id,
-    )
-    await conn.execute(
-        "INSERT INTO addresses (user_id, address) VALUES ($1, $2)", user_id, new_address
+    logging.info(
+        "User %s got a new address: %s", user_id, new_address,
+        extra=event("address_created", user_id=user_id, address=new_address, count=count),
     )
-    await conn.close()
-    logging.info(f"User {user_id} generated a new address: {new_address}")
     await update.message.reply_text(f"Your Bitcoin address:\n\n`{new_address}`", parse_mode="Markdown")
 
 
@@ -351,16 +643,18 @@ async def addresses(update: Update, context: CallbackContext):
     """Handles the /addresses command, listing all addresses the user has generated."""
     user_id = update.effective_user.id
 
-    conn = await get_db_connection()
-    rows = await conn.fetch("SELECT address FROM addresses WHERE user_id = $1", user_id)
-    await conn.close()
+    async with db.acquire() as conn:
+        rows = await conn.fetch("SELECT address FROM addresses WHERE user_id = $1", user_id)
 
     if not rows:
         await update.message.reply_text("You have not generated any addresses yet.")
         return
 
     address_list = "\n".join([row["address"] for row in rows])
-    logging.info(f"User {user_id} checked addresses:\n{address_list}")
+    logging.info(
+        "User %s checked %s addresses", user_id, len(rows),
+        extra=event("addresses_listed", user_id=user_id, count=len(rows)),
+    )
     response = f"Your generated addresses:\n```\n{address_list}\n```"
 
     await update.message.reply_text(response, parse_mode='Markdown')
@@ -374,37 +668,35 @@ async def balance(update: Update, context: CallbackContext):
     balance = await get_user_balance(user_id)
 
     if balance is None:
-        logging.info(f"User {user_id} ({username}) checked balance: No balance found.")
+        logging.info(
+            "User %s (%s) checked balance: no balance found", user_id, username,
+            extra=event("balance_checked", user_id=user_id, balance=None),
+        )
         await update.message.reply_text(f"{username}, you have no balance yet.")
     else:
-        logging.info(f"User {user_id} ({username}) checked balance: {balance} sats.")
+        logging.info(
+            "User %s (%s) checked balance: %s sats", user_id, username, balance,
+            extra=event("balance_checked", user_id=user_id, balance=balance),
+        )
         await update.message.reply_text(
             f"{username}, your balance is {balance} sats 💷"
         )
 
 
-def select_utxos(rpc, amount_btc):
-    utxos = rpc.listunspent(1, 9999999, [])
-    selected, total_input = [], Decimal(0)
+def balance_notify():
+    """Shard workers, and bots sharing the Postgres flip store, tell each
+    other about the balances they change"""
+    return BALANCE_CHANNEL if shard is not None or FLIP_STORE == "postgres" else None
 
-    for utxo in utxos:
-        if total_input >= amount_btc:
-            break
-        selected.append(utxo)
-        total_input += Decimal(utxo["amount"])
-
-    return selected, total_input
 
 async def get_user_balance(user_id: int) -> int:
-    conn = await get_db_connection()
-    balance = await conn.fetchval("SELECT balance FROM balances WHERE user_id = $1", user_id)
-    await conn.close()
+    balance = balances.get(user_id)
+    if balance is MISSING:
+        async with db.acquire() as conn:
+            balance = await conn.fetchval("SELECT balance FROM balances WHERE user_id = $1", user_id)
+        balances.set(user_id, balance)
     return balance
 
-async def update_balance(user_id: int, amount: int):
-    conn = await get_db_connection()
-    await conn.execute("UPDATE balances SET balance = balance - $1 WHERE user_id = $2", amount, user_id)
-    await conn.close()
 
 async def withdraw(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
@@ -417,58 +709,389 @@ async def withdraw(update: Update, context: CallbackContext):
         return
 
     withdraw_address = context.args[0]
+    if not context.args[1].isdigit():
+        await update.message.reply_text("❌ *Amount must be a whole number of sats!*", parse_mode="Markdown")
+        return
     total_sats = int(context.args[1])
-    total_btc = Decimal(total_sats) / Decimal(100_000_000)
 
     # Parse optional fee_rate, default to 1.8 sat/vB
-    fee_rate = Decimal(context.args[2]) if len(context.args) == 3 else Decimal(1.8)
+    try:
+        fee_rate = withdrawals.check_fee_rate(context.args[2] if len(context.args) == 3 else "1.8", MAX_FEE_RATE)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ *Invalid fee rate:* {e}", parse_mode="Markdown")
+        return
+
+    if total_sats < MIN_WITHDRAWAL_SATS:
+        await update.message.reply_text(f"⚠️ Minimum withdrawal is {MIN_WITHDRAWAL_SATS} sats.")
+        return
 
     balance = await get_user_balance(user_id)
-    if balance is None or balance < total_sats:
+    reserved_fee = withdrawals.fee_reserve(fee_rate)
+    if balance is None or balance < total_sats + reserved_fee:
         await update.message.reply_text("⚠️ *Insufficient balance!* Please check your funds. 💰", parse_mode="Markdown")
         return
 
-    rpc = AuthServiceProxy(f"http://{RPC_USER}:{RPC_PASSWORD}@{RPC_HOST}:{RPC_PORT}")
-
     try:
-        options = {"fee_rate": float(fee_rate)}  # Convert Decimal to float for RPC
-        txid = rpc.send([{withdraw_address: float(total_btc)}], None, "unset", None, options)
+        if not (await get_rpc().validateaddress(withdraw_address))["isvalid"]:
+            await update.message.reply_text("❌ *Invalid address!*", parse_mode="Markdown")
+            return
 
-        # Deduct from user balance
-        await update_balance(user_id, total_sats)
+        async with db.acquire() as conn:
+            queued = await withdrawals.request_withdrawal(
+                conn, user_id, withdraw_address, total_sats, fee_rate, balance_notify(), MAX_FEE_RATE
+            )
+        if queued is None:
+            await update.message.reply_text("⚠️ *Insufficient balance!* Please check your funds. 💰", parse_mode="Markdown")
+            return
+        withdrawal_id, balance = queued
+        balances.set(user_id, balance)
+        logging.info(
+            "User %s queued withdrawal %s of %s sats to %s", user_id, withdrawal_id, total_sats, withdraw_address,
+            extra=event(
+                "withdrawal_queued", user_id=user_id, withdrawal_id=withdrawal_id, sats=total_sats,
+                address=withdraw_address,
+            ),
+        )
 
         await update.message.reply_text(
-            f"✅ *Withdrawal Successful!* 🎉\n"
-            f"💸 Sent `{total_sats}` sats to `{withdraw_address}`\n"
-            f"💰 *Fee Rate:* `{fee_rate}` sat/vB\n"
-            f"🔗 *Transaction ID:* `{txid}`",
-            f"🌏 https://mempool.space/tx/{txid}",
+            f"✅ *Withdrawal queued!* 🎉\n"
+            f"💸 `{total_sats}` sats to `{withdraw_address}` go out with the next batch\n"
+            f"💰 *Fee Rate:* `{fee_rate}` sat/vB, up to `{reserved_fee}` sats reserved for your share of the fee, the rest is refunded\n"
+            f"📋 Track it with /withdrawals (#{withdrawal_id})",
             parse_mode="Markdown"
         )
 
     except Exception as e:
-        logging.error(f"Error during withdrawal for user {user_id}: {e}")
-        await update.message.reply_text(f"❌ *Error sending BTC:* `{str(e)}`", parse_mode="Markdown")
+        logging.error(
+            "Error during withdrawal for user %s: %s", user_id, e,
+            extra=event("withdrawal_error", user_id=user_id),
+        )
+        await update.message.reply_text(f"❌ *Error queueing withdrawal:* `{str(e)}`", parse_mode="Markdown")
 
 
-def main():
-    """Starts the bot"""
-    with open(".token", "r") as f:
-        token = f.read().strip()
+async def list_withdrawals(update: Update, context: CallbackContext):
+    """Handles the /withdrawals command, showing the user's recent withdrawals"""
+    user_id = update.effective_user.id
+    async with db.acquire() as conn:
+        rows = await withdrawals.recent_withdrawals(conn, user_id)
+
+    if not rows:
+        await update.message.reply_text("You have not made any withdrawals yet.")
+        return
+
+    status_emoji = {"pending": "⏳", "sending": "📤", "sent": "✅", "failed": "❌", "unknown": "❓"}
+    lines = []
+    for row in rows:
+        line = f"{status_emoji.get(row['status'], '')} #{row['id']} `{row['sats']}` sats to `{row['address']}` – {row['status']}"
+        if row["txid"]:
+            line += f", fee `{row['fee_sats']}` sats\n🌏 https://mempool.space/tx/{row['txid']}"
+        lines.append(line)
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+
+
+async def show_history(update: Update, context: CallbackContext):
+    """Handles /history [id], the user's ledger rows newest first, older than id if given"""
+    user_id = update.effective_user.id
+    if len(context.args) > 1 or (context.args and not context.args[0].isdigit()):
+        await update.message.reply_text("❌ *Usage:* `/history [older than id]`", parse_mode="Markdown")
+        return
+    before = int(context.args[0]) if context.args else None
+
+    async with db.acquire() as conn:
+        rows = await ledger.history(conn, user_id, before)
 
-    logging.info("Starting Telegram bot...")
-    app = Application.builder().token(token).build()
+    if not rows:
+        await update.message.reply_text("No older entries." if before else "You have no history yet.")
+        return
+
+    labels = {
+        "deposit": "📥 Deposit",
+        "coinflip": "🎲 Coinflip",
+        "giveflip": "🎁 Giveflip",
+        "withdrawal": "📤 Withdrawal",
+        "withdrawal_refund": "↩️ Fee refund",
+        "withdrawal_failed": "↩️ Failed withdrawal",
+        "opening": "📒 Opening balance",
+    }
+    lines = [
+        f"{'+' if row['amount'] > 0 else '−'}`{abs(row['amount'])}` sats {labels.get(row['type'], row['type'])}"
+        f" · {row['created_at']:%Y-%m-%d %H:%M}"
+        for row in rows
+    ]
+    if len(rows) == ledger.HISTORY_PAGE_SIZE:
+        lines.append(f"\nOlder: `/history {rows[-1]['id']}`")
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+
+
+async def cached_stats(key, query, *args):
+    result = stats_cache.get(key)
+    if result is None:
+        async with db.acquire() as conn:
+            result = await query(conn, *args)
+        stats_cache.set(key, result)
+    return result
+
+
+def format_stats(title, row):
+    win_rate = row["won"] * 100 // row["played"] if row["played"] else 0
+    return (
+        f"*{title}*\n"
+        f"🎲 Played `{row['played']}`, won `{row['won']}` ({win_rate}%)\n"
+        f"💸 Wagered `{row['wagered']}` sats\n"
+        f"{'📈' if row['net'] >= 0 else '📉'} Net `{row['net']:+}` sats\n"
+        f"🏅 Biggest win `{row['biggest_win']}` sats"
+    )
+
+
+async def show_stats(update: Update, context: CallbackContext):
+    """Handles /stats, the user's totals over all chats and, in a group, in this one"""
+    user = update.effective_user
+    chat = update.effective_chat
+    chat_id = chat.id if chat.type != "private" else None
+    rows = await cached_stats(("player", user.id, chat_id), player_stats.player, user.id, chat_id)
+
+    if player_stats.GLOBAL not in rows:
+        await update.message.reply_text("You have not played any flips yet.")
+        return
+
+    sections = [format_stats("All chats", rows[player_stats.GLOBAL])]
+    if chat_id in rows:
+        sections.append(format_stats("This chat", rows[chat_id]))
+    name = user.username if user.username else user.full_name
+    await update.message.reply_text(f"📊 Stats for {escape_markdown(name)}\n\n" + "\n\n".join(sections), parse_mode="Markdown")
+
+
+async def show_top(update: Update, context: CallbackContext):
+    """Handles /top [chat|global], the leaderboard by net winnings"""
+    chat = update.effective_chat
+    scope = context.args[0].lower() if context.args else ("global" if chat.type == "private" else "chat")
+    if len(context.args) > 1 or scope not in ("chat", "global") or (scope == "chat" and chat.type == "private"):
+        await update.message.reply_text("❌ *Usage:* `/top [chat|global]`, `chat` only in groups", parse_mode="Markdown")
+        return
+    chat_id = player_stats.GLOBAL if scope == "global" else chat.id
+    rows = await cached_stats(("top", chat_id), player_stats.top, chat_id)
+
+    if not rows:
+        await update.message.reply_text("No flips have been settled here yet.")
+        return
+
+    lines = [
+        f"{rank}. {escape_markdown(row['name'] or str(row['user_id']))} `{row['net']:+}` sats ({row['won']}/{row['played']})"
+        for rank, row in enumerate(rows, 1)
+    ]
+    title = "🏆 Top players in all chats" if scope == "global" else "🏆 Top players in this chat"
+    await update.message.reply_text(f"{title}\n\n" + "\n".join(lines), parse_mode="Markdown")
+
+
+def on_balance_changed(conn, pid, channel, payload):
+    balances.invalidate(int(payload))
+
+
+def on_balance_listener_lost(conn):
+    logging.warning(
+        "Lost the balance notification connection, reconnecting", extra=event("balance_listener_lost")
+    )
+    balances.clear()
+    asyncio.get_running_loop().create_task(listen_balance_changes())
+
+
+async def listen_balance_changes():
+    """Drops cached balances that other processes (the deposit checker) changed"""
+    global balance_listener
+    while True:
+        try:
+            balance_listener = await db.connect()
+            await balance_listener.add_listener(BALANCE_CHANNEL, on_balance_changed)
+            balance_listener.add_termination_listener(on_balance_listener_lost)
+            balances.clear()  # anything cached may have missed a notification
+            return
+        except Exception as e:
+            logging.error("Could not listen for balance changes: %s", e, extra=event("balance_listener_error"))
+            await asyncio.sleep(5)
+
+
+async def on_error(update: object, context: CallbackContext):
+    """Counts and logs exceptions escaping handlers"""
+    error = context.error
+    if isinstance(error, TelegramError):
+        TELEGRAM_ERRORS.inc(source="handler", error=type(error).__name__)
+    logging.error(
+        "Error handling update: %s", error, exc_info=error,
+        extra=event("handler_error", error=type(error).__name__),
+    )
+
+
+async def on_startup(app: Application):
+    global flips, edits, metrics_server
+    metrics.instrument_handlers(app)
+    if METRICS_PORT is not None:
+        metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT)
+    await db.init_pool()
+    # Shard workers split the bot's global edit budget between them
+    edits = EditScheduler(
+        app.bot, EDIT_DEBOUNCE, EDIT_CHAT_INTERVAL, EDIT_GLOBAL_RATE / (shard[1] if shard else 1)
+    )
+    edits.start()
+    await listen_balance_changes()
+    flips = flip_store.create_store(FLIP_STORE)
+    open_flips = await flips.open_flips()
+    if shard is not None:
+        # The Postgres store holds every shard's flips, this worker owns its chats' only
+        open_flips = [(key, flip) for key, flip in open_flips if sharding.shard_of(key[0], shard[1]) == shard[0]]
+    for key, flip in open_flips:
+        expiry.track(key, flip["start_time"])
+    logging.info(
+        "Using %s flip store with %s open flips", FLIP_STORE, len(open_flips),
+        extra=event("startup", flip_store=FLIP_STORE, open_flips=len(open_flips)),
+    )
+    app.job_queue.run_repeating(sweep_expired_flips, interval=SWEEP_INTERVAL, first=SWEEP_INTERVAL)
+
+
+async def on_stop(app: Application):
+    await edits.stop()
+
+
+async def on_shutdown(app: Application):
+    if metrics_server is not None:
+        metrics_server.close()
+    if balance_listener is not None:
+        balance_listener.remove_termination_listener(on_balance_listener_lost)
+        await balance_listener.close()
+    await close_rpc()
+    await db.close_pool()
+
+
+def configure():
+    """Applies the COINFLIPPER_BOT_* overrides (see config.py) and rebuilds
+    what is built from the settings they change"""
+    global expiry, balances, stats_cache, trivia_facts, limiter, notices
+    applied = config.configure(globals(), "BOT_")
+    expiry = FlipExpiry(FLIP_TTL, CHAT_FLIP_TTLS)
+    balances = BalanceCache(BALANCE_CACHE_SIZE, BALANCE_CACHE_TTL)
+    stats_cache = player_stats.StatsCache(STATS_CACHE_TTL)
+    trivia_facts = TriviaStore(config.path(TRIVIA_FILE))
+    limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_DEFAULT, RATE_LIMIT_BUCKETS)
+    notices = RateLimiter({}, [("user", 60 / RATE_LIMIT_NOTICE_INTERVAL, 1)], RATE_LIMIT_BUCKETS)
+    return applied
+
+
+def setup_logging(path):
+    structured_log.setup(
+        path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, when=LOG_ROTATE_WHEN, sample_rates=LOG_SAMPLE_RATES
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("telegram").setLevel(logging.WARNING)
+
+
+def build_application(token, updater=True):
+    """The bot's Application with all handlers, without an updater for shard workers"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(CONCURRENT_UPDATES)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    app.add_handler(TypeHandler(Update, rate_limit), group=-1)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("address", address))
     app.add_handler(CommandHandler("addresses", addresses))
     app.add_handler(CommandHandler("balance", balance))
     app.add_handler(CommandHandler("withdraw", withdraw))
+    app.add_handler(CommandHandler("withdrawals", list_withdrawals))
+    app.add_handler(CommandHandler("history", show_history))
+    app.add_handler(CommandHandler("stats", show_stats))
+    app.add_handler(CommandHandler("top", show_top))
     app.add_handler(CommandHandler("coinflip", coinflip))
     app.add_handler(CommandHandler("giveflip", giveflip))
     app.add_handler(CommandHandler("trivia", trivia))
     app.add_handler(CallbackQueryHandler(join_coinflip, pattern="^join_"))
     app.add_handler(CallbackQueryHandler(cancel_coinflip, pattern="^cancel_"))
-    app.run_polling()
+    app.add_handler(CallbackQueryHandler(show_participants, pattern="^show_"))
+    app.add_error_handler(on_error)
+    return app
+
+
+def run(app):
+    """Receives updates from Telegram by webhook or long polling until stopped"""
+    if WEBHOOK_URL:
+        logging.info(
+            "Receiving updates on %s:%s/%s for %s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL,
+            extra=event("webhook", url=WEBHOOK_URL),
+        )
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
+
+
+def run_shard(index, shards, inbox, status):
+    """Entry point of a shard worker process, see sharding.py"""
+    global shard, METRICS_PORT
+    # Ctrl-C reaches the whole process group, the supervisor drains the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # A fresh interpreter, the settings are applied again from the inherited environment
+    configure()
+    shard = (index, shards)
+    if METRICS_PORT is not None:
+        METRICS_PORT += 1 + index
+    root, ext = os.path.splitext(LOG_FILE)
+    setup_logging(f"{root}-{index}{ext}")
+    token = config.bot_token()
+
+    def stats():
+        return {"open_flips": expiry.stats()["live"], "flip_locks": len(flip_locks)}
+
+    asyncio.run(sharding.run_worker(build_application(token, updater=False), index, shards, inbox, status, stats))
+
+
+def supervise(token):
+    """Receives updates and routes them to SHARDS worker processes by chat"""
+    supervisor = sharding.Supervisor(run_shard, SHARDS)
+
+    async def on_supervisor_startup(app):
+        global metrics_server
+        if METRICS_PORT is not None:
+            metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        supervisor.start()
+
+    async def on_supervisor_stop(app):
+        await supervisor.stop()
+        if metrics_server is not None:
+            metrics_server.close()
+
+    app = (
+        Application.builder()
+        .token(token)
+        .post_init(on_supervisor_startup)
+        .post_stop(on_supervisor_stop)
+        .build()
+    )
+    app.add_handler(TypeHandler(Update, supervisor.route))
+    app.add_error_handler(on_error)
+    run(app)
+
+
+def main():
+    """Starts the bot"""
+    overrides = configure()
+    token = config.bot_token()
+
+    setup_logging(LOG_FILE)
+    logging.info("Starting Telegram bot...", extra=event("starting", shards=SHARDS, overrides=overrides))
+    if SHARDS > 1:
+        supervise(token)
+    else:
+        run(build_application(token))
 
 
 if __name__ == "__main__":
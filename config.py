@@ -0,0 +1,122 @@
+"""Settings shared by coinflipper.py and deposit_checker.py, and the loader
+that overrides them and the settings of those two from the environment.
+
+Any setting can be overridden with an environment variable named
+COINFLIPPER_<NAME> for the settings below, COINFLIPPER_BOT_<NAME> for
+coinflipper.py and COINFLIPPER_DEPOSITS_<NAME> for deposit_checker.py:
+
+    COINFLIPPER_DB_PASSWORD=secret
+    COINFLIPPER_BOT_SHARDS=4
+    COINFLIPPER_DEPOSITS_METRICS_PORT=
+
+The same lines can go in a file, COINFLIPPER_CONFIG or coinflipper.env
+next to this module, with the environment taking precedence. Values are
+converted to the type of the default (timedeltas in seconds), and an
+empty value sets None, e.g. to disable the metrics endpoint. Settings
+that are not numbers, strings or timedeltas, such as RATE_LIMITS, are
+only set in code.
+
+Relative paths (TOKEN_FILE, trivia) are resolved against this directory,
+not the working directory.
+"""
+
+import os
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ENV_PREFIX = "COINFLIPPER_"
+CONFIG_FILE = os.environ.get(ENV_PREFIX + "CONFIG", "coinflipper.env")
+
+RPC_USER = "rpcuser"
+RPC_PASSWORD = "123"
+RPC_HOST = "127.0.0.1"
+RPC_PORT = 8332
+RPC_TIMEOUT = 30  # seconds per call, can be overridden per call
+RPC_MAX_CONCURRENCY = 8  # requests in flight to bitcoind at once
+
+DB_HOST = "127.0.0.1"
+DB_NAME = "coinflipper"
+DB_USER = "botuser"
+DB_PASSWORD = "123"
+
+# Connection pool sizing. The bot keeps a few warm connections for bursts of
+# joins in group chats, the deposit checker needs far fewer.
+DB_POOL_MIN_SIZE = 2
+DB_POOL_MAX_SIZE = 10
+DB_POOL_ACQUIRE_TIMEOUT = 5  # seconds to wait for a free connection
+DB_POOL_COMMAND_TIMEOUT = 10  # seconds per statement
+DB_POOL_MAX_IDLE = 300  # close connections idle for longer than this
+
+# The bot token, read from TOKEN_FILE unless set
+TOKEN = None
+TOKEN_FILE = ".token"
+
+_file_settings = None
+
+
+def path(name):
+    return os.path.join(ROOT, name)
+
+
+def file_settings():
+    """NAME=value lines of the config file, read once"""
+    global _file_settings
+    if _file_settings is None:
+        _file_settings = {}
+        try:
+            with open(path(CONFIG_FILE), "r") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            name, sep, value = line.partition("=")
+            if not sep:
+                raise ValueError(f"{CONFIG_FILE}:{number}: expected NAME=value")
+            _file_settings[name.strip()] = value.strip()
+    return _file_settings
+
+
+def convert(value, default):
+    if value == "":
+        return None
+    if isinstance(default, bool):
+        if value.lower() not in ("1", "true", "yes", "0", "false", "no"):
+            raise ValueError(f"{value!r} is not a boolean")
+        return value.lower() in ("1", "true", "yes")
+    if isinstance(default, timedelta):
+        return timedelta(seconds=float(value))
+    if isinstance(default, (int, float)):
+        return type(default)(value)
+    return value
+
+
+def configure(settings, prefix=""):
+    """Overrides the UPPER_CASE entries of a module's globals() from the
+    environment and the config file. Returns the names that were set."""
+    overrides = {**file_settings(), **os.environ}
+    applied = []
+    for name, default in list(settings.items()):
+        key = f"{ENV_PREFIX}{prefix}{name}"
+        if not name.isupper() or key not in overrides:
+            continue
+        if default is not None and not isinstance(default, (bool, int, float, str, timedelta)):
+            raise ValueError(f"{key}: {name} can only be set in code")
+        try:
+            settings[name] = convert(overrides[key], default)
+        except ValueError as e:
+            raise ValueError(f"{key}: {e}") from None
+        applied.append(name)
+    return applied
+
+
+def bot_token():
+    if TOKEN:
+        return TOKEN
+    with open(path(TOKEN_FILE), "r") as f:
+        return f.read().strip()
+
+
+configure(globals())
@@ -0,0 +1,92 @@
+"""Shared asyncpg connection pool.
+
+Create the pool once with init_pool() at startup, borrow connections with
+`async with db.acquire() as conn:` and release everything with close_pool()
+on shutdown.
+"""
+
+import asyncpg
+import logging
+
+import config
+import metrics
+from structured_log import event
+
+pool = None
+
+QUERY_SECONDS = metrics.Histogram("db_query_seconds", "Database statements by leading keyword", ["statement"])
+QUERY_ERRORS = metrics.Counter("db_query_errors_total", "Database statements that raised", ["statement"])
+POOL_CONNECTIONS = metrics.Gauge("db_pool_connections", "Pool connections by state", ["state"])
+POOL_CONNECTIONS.set_function(lambda: {(state,): pool_stats()[state] for state in ("idle", "in_use", "max")})
+
+
+def _observe_query(query):
+    statement = query.query.lstrip().split(None, 1)[0].upper() if query.query.strip() else "?"
+    QUERY_SECONDS.observe(query.elapsed, statement=statement)
+    if query.exception is not None:
+        QUERY_ERRORS.inc(statement=statement)
+
+
+async def _init_connection(conn):
+    conn.add_query_logger(_observe_query)
+
+
+async def init_pool(min_size=None, max_size=None):
+    global pool
+    if pool is not None:
+        return pool
+    pool = await asyncpg.create_pool(
+        host=config.DB_HOST,
+        database=config.DB_NAME,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD,
+        min_size=config.DB_POOL_MIN_SIZE if min_size is None else min_size,
+        max_size=config.DB_POOL_MAX_SIZE if max_size is None else max_size,
+        command_timeout=config.DB_POOL_COMMAND_TIMEOUT,
+        max_inactive_connection_lifetime=config.DB_POOL_MAX_IDLE,
+        init=_init_connection,
+    )
+    logging.info("Database pool ready: %s", pool_stats(), extra=event("db_pool", **pool_stats()))
+    return pool
+
+
+async def close_pool():
+    global pool
+    if pool is None:
+        return
+    logging.info("Closing database pool: %s", pool_stats(), extra=event("db_pool_closing", **pool_stats()))
+    await pool.close()
+    pool = None
+
+
+async def connect():
+    """A dedicated connection outside the pool, e.g. for LISTEN"""
+    return await asyncpg.connect(
+        host=config.DB_HOST,
+        database=config.DB_NAME,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD,
+    )
+
+
+def acquire(timeout=None):
+    """Borrows a connection from the pool, use as `async with acquire() as conn`."""
+    if pool is None:
+        raise RuntimeError("Database pool is not initialised, call init_pool() first")
+    return pool.acquire(
+        timeout=config.DB_POOL_ACQUIRE_TIMEOUT if timeout is None else timeout
+    )
+
+
+def pool_stats():
+    """Current pool usage, for monitoring."""
+    if pool is None:
+        return {"size": 0, "idle": 0, "in_use": 0, "min": 0, "max": 0}
+    size, idle = pool.get_size(), pool.get_idle_size()
+    return {
+        "size": size,
+        "idle": idle,
+        "in_use": size - idle,
+        "min": pool.get_min_size(),
+        "max": pool.get_max_size(),
+    }
@@ -1,104 +1,567 @@
 #!/usr/bin/python3
 
 import asyncio
-import asyncpg
 import logging
-from bitcoinrpc.authproxy import AuthServiceProxy
+import os
+import time
+from datetime import datetime, timezone
 from decimal import Decimal
 
+import address_pool
+import config
+import db
+import ledger
+import metrics
+import structured_log
+import withdrawals
+from coin_selection import UtxoIndex, add_unspent, load_utxos
+from balance_cache import BALANCE_CHANNEL
+from bitcoin_rpc import get_rpc, close_rpc
+from structured_log import event
+
+# JSON lines, rotated at LOG_MAX_BYTES or every LOG_ROTATE_WHEN if set
 LOG_FILE = "/var/log/deposit_checker.log"
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
+LOG_MAX_BYTES = 50_000_000
+LOG_BACKUPS = 5
+LOG_ROTATE_WHEN = None
+# Keep one in N records of these high volume events
+LOG_SAMPLE_RATES = {"scan": 10}
+
+# The checker runs one scan and one withdrawal batch at a time, it needs
+# only a few connections
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 3
+
+
+# Deposits are credited once they have this many confirmations
+MIN_CONFIRMATIONS = 1
+CURSOR_NAME = "deposits"
+
+# Push notifications from bitcoind, both off (None) by default. ZMQ, e.g.
+# "tcp://127.0.0.1:28332", needs `zmqpubhashblock=` and `zmqpubrawtx=` in
+# bitcoin.conf. The socket, e.g. "/run/coinflipper/notify.sock", is fed by
+# `walletnotify=/path/to/notify.sh wallet %s` and
+# `blocknotify=/path/to/notify.sh block %s` writing "<kind> <hash>" lines.
+ZMQ_ENDPOINT = None
+NOTIFY_SOCKET = None
+# Deposits are scanned every POLL_INTERVAL, or every RECONCILE_INTERVAL to
+# catch anything a notification missed while notifications keep arriving
+# (one in the last RECONCILE_INTERVAL).
+RECONCILE_INTERVAL = 600
+POLL_INTERVAL = 60
+
+# Queued withdrawals are paid out together once the oldest has waited
+# WITHDRAWAL_BATCH_WINDOW seconds or WITHDRAWAL_BATCH_SIZE are queued, at
+# most WITHDRAWAL_BATCH_MAX per transaction. Point RPC_PORT at a regtest
+# node (18443) to try it out.
+WITHDRAWAL_BATCH_WINDOW = 600
+WITHDRAWAL_BATCH_SIZE = 20
+WITHDRAWAL_BATCH_MAX = 100
+WITHDRAWAL_MAX_ATTEMPTS = 3
+
+# The ledger is checked against the balances table and the wallet this often
+LEDGER_RECONCILE_INTERVAL = 3600
+
+# Unclaimed deposit addresses for /address, see address_pool.py. Checked
+# every ADDRESS_POOL_INTERVAL seconds and topped up in batches of
+# ADDRESS_POOL_BATCH once fewer than ADDRESS_POOL_LOW_WATER are left.
+ADDRESS_POOL_LOW_WATER = 500
+ADDRESS_POOL_BATCH = 100
+ADDRESS_POOL_INTERVAL = 30
+
+# Message users in Telegram when their deposit is credited or their
+# withdrawal is sent, with the bot token from config.py
+NOTIFY_USERS = False
+
+# GET /metrics on METRICS_HOST:METRICS_PORT, None disables it
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9102
+
+SCAN_SECONDS = metrics.Histogram("deposit_scan_seconds", "Duration of a listsinceblock deposit scan")
+SCAN_TRANSACTIONS = metrics.Histogram(
+    "deposit_scan_transactions", "Wallet transactions returned per scan", buckets=(0, 1, 10, 100, 1000, 10_000, 100_000)
+)
+SCAN_OUTPUTS = metrics.Histogram(
+    "deposit_scan_outputs", "Confirmed receive outputs scanned per pass", buckets=(0, 1, 10, 100, 1000, 10_000, 100_000)
 )
+SCAN_ERRORS = metrics.Counter("deposit_scan_errors_total", "Deposit scans that failed")
+DEPOSITS_CREDITED = metrics.Counter("deposits_credited_total", "Deposit outputs credited", ["source"])
+DEPOSIT_SATS = metrics.Counter("deposit_sats_total", "Sats credited from deposits")
+NOTIFICATIONS = metrics.Counter("bitcoind_notifications_total", "Push notifications from bitcoind", ["kind"])
+WITHDRAWAL_BATCHES = metrics.Counter("withdrawal_batches_total", "Withdrawal batches by outcome", ["status"])
+WITHDRAWALS_PAID = metrics.Counter("withdrawals_total", "Withdrawals by outcome", ["status"])
+UTXO_INDEX = metrics.Gauge("utxo_index_outputs", "Spendable outputs in the coin selection index")
+UTXO_INDEX.set_function(lambda: len(utxo_index))
+ADDRESS_INDEX = metrics.Gauge("address_index_addresses", "Deposit addresses in the in-memory index")
+ADDRESS_INDEX.set_function(lambda: len(address_index))
+ADDRESS_POOL = metrics.Gauge("address_pool_unclaimed", "Unclaimed addresses in the deposit address pool")
+ADDRESSES_POOLED = metrics.Counter("address_pool_added_total", "Addresses added to the deposit address pool")
+LEDGER = metrics.Gauge("ledger_sats", "Ledger totals from the last reconciliation", ["total"])
+
+# address -> user_id, built from the addresses table
+address_index = {}
 
-RPC_USER = "rpcuser"
-RPC_PASSWORD = "123"
-RPC_HOST = "127.0.0.1"
-RPC_PORT = 8332
+# Spendable wallet outputs for coin selection, see coin_selection.py
+utxo_index = UtxoIndex()
 
-DB_HOST = "127.0.0.1"
-DB_NAME = "coinflipper"
-DB_USER = "botuser"
-DB_PASSWORD = "123"
+# telegram.Bot used for user notifications, see NOTIFY_USERS
+bot = None
 
+# time.monotonic() of the last push notification from bitcoind
+last_notification = None
+# Transactions being credited from rawtx notifications
+notification_tasks = set()
 
-async def get_db_connection():
-    return await asyncpg.connect(
-        host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASSWORD
+
+async def load_address_index(conn):
+    rows = await conn.fetch("SELECT address, user_id FROM addresses")
+    address_index.clear()
+    address_index.update((row["address"], row["user_id"]) for row in rows)
+    logging.info(
+        "Loaded %s deposit addresses into the index", len(address_index),
+        extra=event("address_index", addresses=len(address_index)),
     )
 
 
-def get_rpc_connection():
-    return AuthServiceProxy(f"http://{RPC_USER}:{RPC_PASSWORD}@{RPC_HOST}:{RPC_PORT}")
+async def resolve_users(conn, addresses):
+    """Maps addresses to user ids, fetching addresses created since the index was built."""
+    missing = [a for a in set(addresses) if a not in address_index]
+    if missing:
+        rows = await conn.fetch(
+            "SELECT address, user_id FROM addresses WHERE address = ANY($1::text[])",
+            missing,
+        )
+        address_index.update((row["address"], row["user_id"]) for row in rows)
+    return {a: address_index[a] for a in addresses if a in address_index}
+
+
+async def credit_deposits(conn, deposits):
+    """Credits [(user_id, sats, txid, vout), ...] in one statement.
+
+    Each deposit is a ledger entry crediting the user and debiting
+    ledger.DEPOSITS. Outputs already in the ledger are skipped by the
+    (txid, vout) unique index, which only the user's row carries.
+    Returns the rows that were actually credited. Run it inside a
+    transaction so the balance notifications go out with the commit.
+    """
+    if not deposits:
+        return []
+    user_ids, amounts, txids, vouts = zip(*deposits)
+    credited = await conn.fetch(
+        """
+        WITH new AS (
+            INSERT INTO transactions (user_id, type, amount, txid, vout)
+            SELECT user_id, 'deposit', amount, txid, vout
+            FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::int[])
+                AS d(user_id, amount, txid, vout)
+            ON CONFLICT (txid, vout) DO NOTHING
+            RETURNING user_id, amount, txid, vout, entry_id
+        ), counter AS (
+            INSERT INTO transactions (user_id, type, amount, entry_id, ref)
+            SELECT $5, 'deposit', -amount, entry_id, txid || ':' || vout FROM new
+        ), credited AS (
+            UPDATE balances b SET balance = b.balance + c.amount
+            FROM (SELECT user_id, SUM(amount) AS amount FROM new GROUP BY user_id) c
+            WHERE b.user_id = c.user_id
+        )
+        SELECT user_id, amount, txid, vout FROM new
+        """,
+        list(user_ids),
+        list(amounts),
+        list(txids),
+        list(vouts),
+        ledger.DEPOSITS,
+    )
+    # Delivered on commit, tells the bot to drop its cached balances
+    await conn.execute(
+        "SELECT pg_notify($1, user_id::text) FROM unnest($2::bigint[]) AS user_id",
+        BALANCE_CHANNEL,
+        list({row["user_id"] for row in credited}),
+    )
+    return credited
+
+
+def received_deposits(entries, users):
+    """Turns wallet "receive" entries into (user_id, sats, txid, vout) tuples"""
+    return [
+        (users[tx["address"]], int(100_000_000 * Decimal(tx["amount"])), tx["txid"], tx["vout"])
+        for tx in entries
+        if tx["address"] in users
+    ]
+
+
+async def report_credited(credited, source):
+    DEPOSITS_CREDITED.inc(len(credited), source=source)
+    DEPOSIT_SATS.inc(sum(row["amount"] for row in credited))
+    for row in credited:
+        logging.info(
+            "Deposited %s sats to user %s (TXID: %s, VOUT: %s)", row["amount"], row["user_id"], row["txid"], row["vout"],
+            extra=event("deposit", user_id=row["user_id"], sats=row["amount"], txid=row["txid"], vout=row["vout"]),
+        )
+    for row in credited:
+        await notify_user(
+            row["user_id"],
+            f"💰 Your deposit of {row['amount']} sats has been credited!\n🔗 `{row['txid']}`",
+        )
+
+
+async def notify_user(user_id, text):
+    if bot is None:
+        return
+    try:
+        await bot.send_message(chat_id=user_id, text=text, parse_mode="Markdown")
+    except Exception as e:
+        logging.warning("Could not notify user %s: %s", user_id, e, extra=event("notify_failed", user_id=user_id))
 
 
 async def check_deposits():
-    """Scans for new deposits and updates user balances"""
+    """Scans for deposits since the last scanned block and updates user balances"""
 
+    started = time.perf_counter()
     try:
-        rpc = get_rpc_connection()
-        conn = await get_db_connection()
+        rpc = get_rpc()
+        async with db.acquire() as conn:
+            if not address_index:
+                await load_address_index(conn)
 
-        unspent_txs = rpc.listunspent()
+            cursor = await conn.fetchval(
+                "SELECT block_hash FROM scanner_state WHERE name = $1", CURSOR_NAME
+            )
+            # With target_confirmations the returned lastblock stays far enough
+            # behind the tip that not yet confirmed deposits show up again.
+            since = await rpc.listsinceblock(cursor, MIN_CONFIRMATIONS, False, True)
 
-        for tx in unspent_txs:
-            txid = tx["txid"]
-            vout = tx["vout"]
-            address = tx["address"]
-            amount = int(100_000_000 * Decimal(tx["amount"]))
+            received = [
+                tx for tx in since["transactions"]
+                if tx["category"] == "receive" and tx["confirmations"] >= MIN_CONFIRMATIONS
+            ]
+            # Outputs received since the cursor may have been spent already
+            await add_unspent(rpc, utxo_index, received)
+            users = await resolve_users(conn, [tx["address"] for tx in received])
+            deposits = received_deposits(received, users)
 
-            labels = rpc.getaddressinfo(address).get("labels", [])
-            if not labels:
-                continue
+            async with conn.transaction():
+                credited = await credit_deposits(conn, deposits)
+                await conn.execute(
+                    """
+                    INSERT INTO scanner_state (name, block_hash) VALUES ($1, $2)
+                    ON CONFLICT (name) DO UPDATE SET block_hash = EXCLUDED.block_hash, updated_at = now()
+                    """,
+                    CURSOR_NAME,
+                    since["lastblock"],
+                )
 
-            label = labels[0]  # Example: "user_123456789"
-            if not label.startswith("user_"):
-                continue
+        await report_credited(credited, "scan")
+        for tx in since.get("removed", []):
+            if tx["category"] == "receive" and tx["address"] in address_index:
+                user_id = address_index[tx["address"]]
+                logging.warning(
+                    "Deposit %s:%s to user %s was removed by a reorg", tx["txid"], tx["vout"], user_id,
+                    extra=event("deposit_reorged", user_id=user_id, txid=tx["txid"], vout=tx["vout"]),
+                )
+        elapsed = time.perf_counter() - started
+        SCAN_SECONDS.observe(elapsed)
+        SCAN_TRANSACTIONS.observe(len(since["transactions"]))
+        SCAN_OUTPUTS.observe(len(received))
+        logging.info(
+            "Scanned %s wallet transactions since %s, credited %s deposits",
+            len(since["transactions"]), cursor, len(credited),
+            extra=event(
+                "scan",
+                transactions=len(since["transactions"]),
+                credited=len(credited),
+                latency_ms=round(elapsed * 1000, 2),
+            ),
+        )
+    except Exception as e:
+        SCAN_ERRORS.inc()
+        logging.error("Error in check_deposits: %s", e, extra=event("scan_error"))
 
-            user_id = int(label.split("_")[1])
 
-            tx_exists = await conn.fetchval(
-                "SELECT COUNT(*) FROM transactions WHERE txid = $1 AND vout = $2",
-                txid,
-                vout,
-            )
+async def process_transactions(txids):
+    """Credits deposits in the given wallet transactions, skipping the full scan"""
 
-            if tx_exists:
-                continue
+    try:
+        rpc = get_rpc()
+        txs = await rpc.batch([("gettransaction", [txid]) for txid in txids], raise_errors=False)
+        received = [
+            dict(detail, txid=tx["txid"])
+            for tx in txs
+            if isinstance(tx, dict) and tx["confirmations"] >= MIN_CONFIRMATIONS
+            for detail in tx["details"]
+            if detail["category"] == "receive"
+        ]
+        if not received:
+            return
+        async with db.acquire() as conn:
+            users = await resolve_users(conn, [tx["address"] for tx in received])
+            async with conn.transaction():
+                credited = await credit_deposits(conn, received_deposits(received, users))
+        await report_credited(credited, "notification")
+    except Exception as e:
+        logging.error("Error processing transactions %s: %s", txids, e, extra=event("notify_error", txids=txids))
 
-            await conn.execute(
-                "UPDATE balances SET balance = balance + $1 WHERE user_id = $2",
-                amount,
-                user_id,
-            )
 
-            await conn.execute(
-                "INSERT INTO transactions (user_id, type, amount, txid, vout) VALUES ($1, 'deposit', $2, $3, $4)",
-                user_id,
-                amount,
-                txid,
-                vout,
-            )
+async def process_raw_transaction(raw_hex):
+    """Handles a rawtx notification, only looking further at outputs to our addresses"""
+
+    try:
+        tx = await get_rpc().decoderawtransaction(raw_hex)
+    except Exception as e:
+        logging.error("Could not decode raw transaction: %s", e, extra=event("notify_error"))
+        return
+    addresses = [
+        out["scriptPubKey"].get("address")
+        for out in tx["vout"]
+    ]
+    if any(a in address_index for a in addresses):
+        await process_transactions([tx["txid"]])
+
+
+def notified(kind):
+    global last_notification
+    last_notification = time.monotonic()
+    NOTIFICATIONS.inc(kind=kind)
 
-            logging.info(
-                f"Deposited {amount} sats to user {user_id} (TXID: {txid}, VOUT: {vout})"
+
+def notification_done(task):
+    notification_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("Error handling a notification: %s", task.exception(), extra=event("notify_error"))
+
+
+async def listen_zmq(endpoint, new_block):
+    """Subscribes to bitcoind's hashblock and rawtx ZMQ topics"""
+    import zmq
+    import zmq.asyncio
+
+    context = zmq.asyncio.Context.instance()
+    socket = context.socket(zmq.SUB)
+    socket.setsockopt(zmq.RCVHWM, 0)
+    socket.setsockopt_string(zmq.SUBSCRIBE, "hashblock")
+    if MIN_CONFIRMATIONS == 0:
+        # Mempool transactions only matter when unconfirmed deposits count,
+        # otherwise the scan triggered by hashblock picks them up.
+        socket.setsockopt_string(zmq.SUBSCRIBE, "rawtx")
+    socket.connect(endpoint)
+    logging.info("Listening for bitcoind ZMQ notifications on %s", endpoint, extra=event("zmq", endpoint=endpoint))
+    try:
+        while True:
+            topic, body, *_ = await socket.recv_multipart()
+            notified(topic.decode())
+            if topic == b"hashblock":
+                logging.debug("New block %s", body.hex(), extra=event("block"))
+                new_block.set()
+            elif topic == b"rawtx":
+                task = asyncio.create_task(process_raw_transaction(body.hex()))
+                notification_tasks.add(task)
+                task.add_done_callback(notification_done)
+    finally:
+        socket.close(linger=0)
+
+
+async def serve_notify_socket(path, new_block):
+    """Accepts "wallet <txid>" and "block <hash>" lines from bitcoind's notify hooks"""
+
+    async def handle(reader, writer):
+        try:
+            async for line in reader:
+                kind, _, value = line.decode().strip().partition(" ")
+                notified(kind if kind in ("wallet", "block") else "unknown")
+                if kind == "wallet" and value:
+                    await process_transactions([value])
+                elif kind == "block":
+                    new_block.set()
+                else:
+                    logging.warning("Ignoring unknown notification %r", line, extra=event("notify_unknown"))
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)  # left behind by a previous run
+    server = await asyncio.start_unix_server(handle, path=path)
+    logging.info("Listening for walletnotify/blocknotify on %s", path, extra=event("notify_socket", path=path))
+    return server
+
+
+async def reload_utxos():
+    try:
+        await load_utxos(get_rpc(), utxo_index)
+        logging.info("UTXO index holds %s outputs", len(utxo_index), extra=event("utxos", utxos=len(utxo_index)))
+    except Exception as e:
+        logging.error("Could not load UTXOs: %s", e, extra=event("utxos_error"))
+
+
+async def report_withdrawals(status, batch):
+    for w in batch:
+        if status == "sent":
+            text = (
+                f"📤 Your withdrawal #{w['id']} of {w['sats']} sats was sent, fee {w['fee_sats']} sats\n"
+                f"🌏 https://mempool.space/tx/{w['txid']}"
             )
+        elif status == "failed":
+            text = f"❌ Your withdrawal #{w['id']} failed and {w['sats'] + w['reserved_fee']} sats were refunded"
+        else:
+            text = f"❓ Your withdrawal #{w['id']} is delayed and being looked into"
+        await notify_user(w["user_id"], text)
+
+
+async def run_withdrawals():
+    """Pays out queued withdrawals in batches"""
+
+    requested = asyncio.Event()
+    listener = await db.connect()
+    await listener.add_listener(withdrawals.WITHDRAWAL_CHANNEL, lambda *args: requested.set())
+    async with db.acquire() as conn:
+        await withdrawals.recover_interrupted(conn)
+
+    try:
+        while True:
+            wait = WITHDRAWAL_BATCH_WINDOW
+            try:
+                async with db.acquire() as conn:
+                    count, oldest = await withdrawals.pending_summary(conn)
+                if count:
+                    waited = (datetime.now(timezone.utc) - oldest).total_seconds()
+                    if count >= WITHDRAWAL_BATCH_SIZE or waited >= WITHDRAWAL_BATCH_WINDOW:
+                        status, batch = await withdrawals.process_batch(
+                            get_rpc(), WITHDRAWAL_BATCH_MAX, WITHDRAWAL_MAX_ATTEMPTS, utxo_index
+                        )
+                        if status is not None:
+                            WITHDRAWAL_BATCHES.inc(status=status)
+                            WITHDRAWALS_PAID.inc(len(batch), status=status)
+                        await report_withdrawals(status, batch)
+                        if status == "sent":
+                            continue  # more may be waiting
+                    else:
+                        wait = WITHDRAWAL_BATCH_WINDOW - waited
+            except Exception as e:
+                logging.error("Error paying out withdrawals: %s", e, extra=event("withdrawal_error"))
+
+            requested.clear()
+            try:
+                await asyncio.wait_for(requested.wait(), timeout=max(wait, 1))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await listener.close()
+
 
-        await conn.close()
+async def reconcile_ledger():
+    """Checks that the ledger balances, matches balances and is covered by the wallet"""
+    try:
+        # Trusted funds are confirmed deposits plus our own unconfirmed change
+        wallet = await get_rpc().getbalances()
+        wallet_sats = int(wallet["mine"]["trusted"] * 100_000_000)
+        async with db.acquire() as conn:
+            result = await ledger.reconcile(conn, wallet_sats)
     except Exception as e:
-        logging.error(f"Error in check_deposits: {e}")
+        logging.error("Could not reconcile the ledger: %s", e, extra=event("reconcile_error"))
+        return
+    for name, value in result.items():
+        LEDGER.set(value, total=name)
+    ok = result["total"] == 0 and result["balances"] == result["users"] and result["wallet_difference"] >= 0
+    logging.log(
+        logging.INFO if ok else logging.WARNING,
+        "Ledger %s: %s", "reconciled" if ok else "does not reconcile", result,
+        extra=event("ledger_reconcile", ok=ok, **result),
+    )
+
+
+async def run_reconciliation():
+    while True:
+        await reconcile_ledger()
+        await asyncio.sleep(LEDGER_RECONCILE_INTERVAL)
+
+
+async def run_address_pool():
+    """Keeps the deposit address pool above its low-water mark"""
+    while True:
+        try:
+            async with db.acquire() as conn:
+                depth, added = await address_pool.refill(
+                    conn, get_rpc(), ADDRESS_POOL_LOW_WATER, ADDRESS_POOL_BATCH
+                )
+            ADDRESS_POOL.set(depth)
+            ADDRESSES_POOLED.inc(added)
+        except Exception as e:
+            logging.error("Could not refill the address pool: %s", e, extra=event("address_pool_error"))
+        await asyncio.sleep(ADDRESS_POOL_INTERVAL)
 
 
 async def main():
-    while True == True: # Joke
-        logging.info("⏰ Checking 100 times for new deposits...")
-        for _ in range(100):
+    global bot
+    await db.init_pool(min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE)
+    metrics_server = None
+    server = None
+    listeners = []
+    new_block = asyncio.Event()
+
+    try:
+        if NOTIFY_USERS:
+            from telegram import Bot
+
+            bot = Bot(config.bot_token())
+            await bot.initialize()
+
+        metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT) if METRICS_PORT is not None else None
+        listeners = [
+            asyncio.create_task(run_withdrawals()),
+            asyncio.create_task(run_reconciliation()),
+            asyncio.create_task(run_address_pool()),
+        ]
+        if ZMQ_ENDPOINT:
+            try:
+                import zmq.asyncio  # noqa: F401
+            except ImportError:
+                logging.error("pyzmq is not installed, ZMQ notifications are disabled", extra=event("zmq_missing"))
+            else:
+                listeners.append(asyncio.create_task(listen_zmq(ZMQ_ENDPOINT, new_block)))
+        if NOTIFY_SOCKET:
+            try:
+                server = await serve_notify_socket(NOTIFY_SOCKET, new_block)
+            except OSError as e:
+                logging.error(
+                    "Could not listen on %s, walletnotify/blocknotify are disabled: %s", NOTIFY_SOCKET, e,
+                    extra=event("notify_socket_error", path=NOTIFY_SOCKET),
+                )
+
+        async with db.acquire() as conn:
+            await load_address_index(conn)
+        await reload_utxos()
+        while True == True: # Joke
             await check_deposits()
-            await asyncio.sleep(60)
+            # Poll until bitcoind is seen to push notifications, and again if they stop
+            pushed = last_notification is not None and time.monotonic() - last_notification < RECONCILE_INTERVAL
+            interval = RECONCILE_INTERVAL if pushed else POLL_INTERVAL
+            try:
+                await asyncio.wait_for(new_block.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                logging.info("⏰ Reconciling deposits... (db pool: %s)", db.pool_stats(), extra=event("reconcile"))
+                await reload_utxos()
+            new_block.clear()
+    finally:
+        for task in listeners + list(notification_tasks):
+            task.cancel()
+        if server is not None:
+            server.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if bot is not None:
+            await bot.shutdown()
+        await close_rpc()
+        await db.close_pool()
 
 
-if __name__ == "__main__":
-    logging.info("Starting deposit checker...")
+def run():
+    """Starts the deposit checker with the COINFLIPPER_DEPOSITS_* overrides, see config.py"""
+    overrides = config.configure(globals(), "DEPOSITS_")
+    structured_log.setup(
+        LOG_FILE, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, when=LOG_ROTATE_WHEN, sample_rates=LOG_SAMPLE_RATES
+    )
+    logging.info("Starting deposit checker...", extra=event("starting", overrides=overrides))
     asyncio.run(main())
+
+
+if __name__ == "__main__":
+    run()
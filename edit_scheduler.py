@@ -0,0 +1,146 @@
+"""Coalesces message edits and keeps them within Telegram's rate limits.
+
+Handlers call schedule() instead of editing a message directly. Edits to
+the same message within `debounce` seconds collapse into one carrying the
+latest text, each chat gets at most one edit per `chat_interval` and all
+chats share a global budget. Final edits (a flip's result or its
+cancellation) replace whatever is pending for that message and go out
+before anything else. A RetryAfter from Telegram pauses the chat for the
+requested time and the edit is retried.
+"""
+
+import asyncio
+import logging
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+import metrics
+from structured_log import event
+
+TELEGRAM_ERRORS = metrics.Counter(
+    "telegram_errors_total", "Telegram API errors, RetryAfter being a 429", ["source", "error"]
+)
+EDITS_SENT = metrics.Counter("telegram_edits_total", "Message edits sent by the edit scheduler")
+
+
+def retry_after_seconds(error):
+    # Newer python-telegram-bot releases report a timedelta
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else retry_after
+
+
+class EditScheduler:
+    def __init__(self, bot, debounce=0.5, chat_interval=3.0, global_rate=25):
+        self.bot = bot
+        self.debounce = debounce
+        self.chat_interval = chat_interval
+        self.global_interval = 1 / global_rate
+        self.pending = {}  # (chat_id, message_id) -> [text, reply_markup, final, due]
+        self.chat_free_at = {}  # chat_id -> loop time of its next allowed edit
+        self.global_free_at = 0
+        self.stats = {"scheduled": 0, "sent": 0, "coalesced": 0, "retry_after": 0, "failed": 0}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sending_final = False
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout=5):
+        """Stops the worker, giving pending final edits up to `timeout` seconds to go out"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline and (
+            self._sending_final or any(edit[2] for edit in self.pending.values())
+        ):
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def schedule(self, chat_id, message_id, text, reply_markup=None, final=False):
+        loop_time = asyncio.get_running_loop().time()
+        key = (chat_id, message_id)
+        self.stats["scheduled"] += 1
+        edit = self.pending.get(key)
+        if edit is not None:
+            self.stats["coalesced"] += 1
+            if edit[2] and not final:
+                return  # never replace a result with a participant update
+            edit[0], edit[1] = text, reply_markup
+            if final:
+                edit[2], edit[3] = True, loop_time
+        else:
+            self.pending[key] = [text, reply_markup, final, loop_time if final else loop_time + self.debounce]
+        self._wakeup.set()
+
+    def _next(self, now):
+        """The key to edit now, or None and how long to wait"""
+        best, best_rank, wait = None, None, 60.0
+        for key, (_, _, final, due) in self.pending.items():
+            ready_at = max(due, self.chat_free_at.get(key[0], 0), self.global_free_at)
+            if ready_at > now:
+                wait = min(wait, ready_at - now)
+                continue
+            rank = (not final, due)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = key, rank
+        return best, wait
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            key, wait = self._next(loop.time())
+            if key is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            edit = self.pending.pop(key)
+            text, reply_markup, final, _ = edit
+            now = loop.time()
+            self.chat_free_at[key[0]] = now + self.chat_interval
+            self.global_free_at = now + self.global_interval
+            self._sending_final = final
+            try:
+                await self.bot.edit_message_text(
+                    chat_id=key[0], message_id=key[1], text=text, reply_markup=reply_markup
+                )
+                self.stats["sent"] += 1
+                EDITS_SENT.inc()
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                TELEGRAM_ERRORS.inc(source="edit", error="RetryAfter")
+                delay = retry_after_seconds(e)
+                self.chat_free_at[key[0]] = loop.time() + delay
+                logging.warning(
+                    "Edits to chat %s rate limited for %ss", key[0], delay,
+                    extra=event("retry_after", chat_id=key[0], delay=delay),
+                )
+                # Requeue unless a newer edit for the message arrived meanwhile
+                if key not in self.pending:
+                    self.pending[key] = edit
+            except BadRequest as e:
+                if "not modified" not in str(e):
+                    self.stats["failed"] += 1
+                    TELEGRAM_ERRORS.inc(source="edit", error=type(e).__name__)
+                    logging.warning(
+                        "Could not edit message %s in chat %s: %s", key[1], key[0], e,
+                        extra=event("edit_failed", chat_id=key[0], message_id=key[1]),
+                    )
+            except TelegramError as e:
+                self.stats["failed"] += 1
+                TELEGRAM_ERRORS.inc(source="edit", error=type(e).__name__)
+                logging.warning(
+                    "Could not edit message %s in chat %s: %s", key[1], key[0], e,
+                    extra=event("edit_failed", chat_id=key[0], message_id=key[1]),
+                )
+            self._sending_final = False
+            self._prune(loop.time())
+
+    def _prune(self, now):
+        if len(self.chat_free_at) > 10_000:
+            self.chat_free_at = {c: t for c, t in self.chat_free_at.items() if t > now}
@@ -0,0 +1,144 @@
+"""Verifiable winner selection.
+
+Every flip gets a random 32 byte seed from the OS when it is created. Its
+SHA-256 commitment is published in the flip announcement, the seed itself
+is revealed with the result. Draws are a deterministic function of the
+seed and the ordered participant ids, so anyone holding the revealed seed
+can check that it matches the commitment and recompute the winners:
+
+    commitment(seed) == published_commitment
+    draw_winners(seed, participant_ids) == [winner]
+
+Random numbers come from HMAC-SHA256(seed, participants || counter) with
+rejection sampling, so every participant is exactly equally likely (or
+proportional to their weight for weighted draws).
+"""
+
+import hashlib
+import hmac
+import math
+import secrets
+import struct
+
+SEED_BYTES = 32
+_LIMIT = 1 << 64
+# HMAC pads, applied with bytes.translate since the hmac module's own
+# one-shot path is several times slower than two hashlib copies
+_IPAD = bytes(b ^ 0x36 for b in range(256))
+_OPAD = bytes(b ^ 0x5C for b in range(256))
+
+
+def new_seed():
+    return secrets.token_bytes(SEED_BYTES)
+
+
+def commitment(seed):
+    return hashlib.sha256(seed).hexdigest()
+
+
+def verify(seed, published_commitment):
+    return hmac.compare_digest(commitment(seed), published_commitment)
+
+
+class _Stream:
+    """Uniform integers derived from a seed and the participant ids"""
+
+    def __init__(self, seed, participant_ids):
+        key = seed.ljust(64, b"\0")
+        self._inner = hashlib.sha256(key.translate(_IPAD))
+        self._inner.update(struct.pack(f">{len(participant_ids)}q", *participant_ids))
+        self._outer = hashlib.sha256(key.translate(_OPAD))
+        self._counter = 0
+        self._buffer = []
+
+    def _next64(self):
+        if not self._buffer:
+            inner = self._inner.copy()
+            inner.update(struct.pack(">Q", self._counter))
+            outer = self._outer.copy()
+            outer.update(inner.digest())
+            self._counter += 1
+            self._buffer = list(struct.unpack(">4Q", outer.digest()))
+        return self._buffer.pop()
+
+    def below(self, n):
+        """Uniform integer in [0, n)"""
+        if n <= 0:
+            raise ValueError("n must be positive")
+        cutoff = _LIMIT - _LIMIT % n
+        while True:
+            x = self._next64()
+            if x < cutoff:
+                return x % n
+
+
+def draw_indices(seed, participant_ids, k=1, weights=None):
+    """Indices of k distinct winners among participant_ids.
+
+    With weights (non-negative integers, e.g. sats entered) each pick is
+    proportional to the weights of those not yet picked.
+    """
+    n = len(participant_ids)
+    if not 0 < k <= n:
+        raise ValueError(f"Cannot draw {k} winners from {n} participants")
+    stream = _Stream(seed, participant_ids)
+
+    if weights is None:
+        # Partial Fisher-Yates shuffle, tracking only the swapped slots
+        swapped, picked = {}, []
+        for i in range(k):
+            j = i + stream.below(n - i)
+            picked.append(swapped.get(j, j))
+            swapped[j] = swapped.get(i, i)
+        return picked
+
+    weights = [int(w) for w in weights]
+    if len(weights) != n or any(w < 0 for w in weights):
+        raise ValueError("Need one non-negative integer weight per participant")
+    picked = []
+    remaining = sum(weights)
+    for _ in range(k):
+        if remaining == 0:
+            raise ValueError("Not enough participants with a positive weight")
+        target = stream.below(remaining)
+        for i, w in enumerate(weights):
+            if target < w:
+                break
+            target -= w
+        picked.append(i)
+        remaining -= weights[i]
+        weights[i] = 0
+    return picked
+
+
+def draw_winners(seed, participant_ids, k=1, weights=None):
+    return [participant_ids[i] for i in draw_indices(seed, participant_ids, k, weights)]
+
+
+def draw_batch(seeds, participant_lists, k=1):
+    """Winners for many flips at once, e.g. to settle or replay a backlog"""
+    return [draw_winners(seed, ids, k) for seed, ids in zip(seeds, participant_lists)]
+
+
+def replay(results):
+    """Checks recorded results, dicts with seed, commitment, participants and winners.
+
+    Returns the results that do not verify.
+    """
+    bad = []
+    for result in results:
+        seed = bytes.fromhex(result["seed"]) if isinstance(result["seed"], str) else result["seed"]
+        winners = list(result["winners"])
+        if not verify(seed, result["commitment"]) or draw_winners(
+            seed, list(result["participants"]), len(winners)
+        ) != winners:
+            bad.append(result)
+    return bad
+
+
+def chi_square(counts, expected):
+    """Chi-square statistic and an approximate p-value (Wilson-Hilferty)"""
+    statistic = sum((c - e) ** 2 / e for c, e in zip(counts, expected))
+    dof = len(counts) - 1
+    z = ((statistic / dof) ** (1 / 3) - (1 - 2 / (9 * dof))) / math.sqrt(2 / (9 * dof))
+    return statistic, 0.5 * math.erfc(z / math.sqrt(2))
@@ -0,0 +1,50 @@
+"""Deadlines of open flips, kept in a min-heap.
+
+The sweeper only pops flips whose deadline has passed, so a sweep costs
+O(expired * log n) no matter how many flips are open. Flips that end
+early are dropped from `deadlines` and their heap entries are skipped
+lazily when they surface.
+"""
+
+import heapq
+from datetime import timedelta
+
+
+class FlipExpiry:
+    def __init__(self, default_ttl=timedelta(days=1), chat_ttls=None):
+        self.default_ttl = default_ttl
+        self.chat_ttls = dict(chat_ttls or {})
+        self.deadlines = {}
+        self.heap = []
+        self.expired = 0
+
+    def ttl_for(self, chat_id):
+        return self.chat_ttls.get(chat_id, self.default_ttl)
+
+    def track(self, key, start_time):
+        deadline = start_time + self.ttl_for(key[0])
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+
+    def forget(self, key):
+        self.deadlines.pop(key, None)
+
+    def is_expired(self, key, start_time, now):
+        return now - start_time > self.ttl_for(key[0])
+
+    def pop_due(self, now):
+        """Removes and returns the keys of all flips past their deadline"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                due.append(key)
+        # Rebuild once stale entries dominate so the heap stays bounded
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(d, k) for k, d in self.deadlines.items()]
+            heapq.heapify(self.heap)
+        return due
+
+    def stats(self):
+        return {"live": len(self.deadlines), "expired": self.expired}
@@ -0,0 +1,91 @@
+"""Text and keyboard of a flip's announcement, kept up to date as players join.
+
+A FlipMessage is built once per open flip. Its keyboard is built once,
+and each join appends one name to the participant text, so an edit costs
+the same for the 1000th player as for the 2nd. Names are listed until
+the list reaches SHOWN_PARTICIPANTS or its share of Telegram's message
+limit. After that the message ends in "...and N more" and gets a "Show
+participants" button, which sends the full list in private (see
+participant_pages()).
+
+Telegram counts message length in UTF-16 code units, so that is what
+is measured here too.
+"""
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+MESSAGE_LIMIT = 4096
+SHOWN_PARTICIPANTS = 100
+# Room left for what the result message adds: the winner, prize and seed
+RESULT_RESERVE = 300
+
+
+def text_length(text):
+    """Length as Telegram counts it, in UTF-16 code units"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+class FlipMessage:
+    def __init__(self, key, flip, commitment=None):
+        chat_id, msg_id = key
+        kind = "🎁 Giveflip" if flip["is_giveflip"] else "🎲 Coinflip"
+        entry = "given" if flip["is_giveflip"] else "entry"
+        players = f"{flip['max']} player{'s' if flip['max'] > 1 else ''}"
+        self.header = f"{kind} started! {flip['sats']} sats {entry}. {players} needed."
+        if commitment:
+            self.header += f"\n\n🔒 Commitment: {commitment}"
+        self.budget = MESSAGE_LIMIT - RESULT_RESERVE - text_length(self.header)
+        self.listed = ""  # "\n"-joined names shown in the message
+        self.listed_length = 0
+        self.shown = 0
+        self.count = 0
+        join = [InlineKeyboardButton("Join", callback_data=f"join_{chat_id}_{msg_id}")]
+        cancel = [InlineKeyboardButton("Cancel", callback_data=f"cancel_{chat_id}_{msg_id}")]
+        show = [InlineKeyboardButton("Show participants", callback_data=f"show_{chat_id}_{msg_id}")]
+        self.keyboard = InlineKeyboardMarkup([join, cancel])
+        self.long_keyboard = InlineKeyboardMarkup([join, show, cancel])
+        self.sync(flip["participants"])
+
+    def sync(self, participants):
+        """Adds the participants that joined since the last call"""
+        for _, name in participants[self.count:]:
+            self.count += 1
+            if self.shown == self.count - 1 and self.shown < SHOWN_PARTICIPANTS:
+                length = text_length(name) + 1
+                if self.listed_length + length <= self.budget:
+                    self.listed = f"{self.listed}\n{name}" if self.listed else name
+                    self.listed_length += length
+                    self.shown += 1
+
+    @property
+    def hidden(self):
+        return self.count - self.shown
+
+    @property
+    def reply_markup(self):
+        return self.long_keyboard if self.hidden else self.keyboard
+
+    def participants(self):
+        """The participant list as shown, ending in "...and N more" if truncated"""
+        if self.hidden:
+            return f"{self.listed}\n...and {self.hidden} more"
+        return self.listed
+
+    def text(self):
+        if not self.count:
+            return self.header
+        return f"{self.header}\n\nParticipants:\n{self.participants()}"
+
+
+def participant_pages(names, limit=MESSAGE_LIMIT):
+    """Splits the full list of names into messages within Telegram's limit"""
+    page, length = [], 0
+    for name in names:
+        size = text_length(name) + 1
+        if page and length + size > limit:
+            yield "\n".join(page)
+            page, length = [], 0
+        page.append(name)
+        length += size
+    if page:
+        yield "\n".join(page)
@@ -0,0 +1,180 @@
+"""Where open flips live between the /coinflip command and settlement.
+
+Flips are dicts with creator, sats, max, participants [(user_id, name)],
+start_time, is_giveflip, announcement_id (the bot's message) and seed
+(see fair_random), keyed by (chat_id, message_id). Both stores offer the
+same async interface:
+
+    create(key, flip)      store a new flip
+    get(key)               the flip or None
+    join(key, user_id, name) -> (status, flip), status one of
+                           "joined", "already", "full" or "missing"
+    take(key)              remove the flip, returning it only to the one
+                           caller that removed it
+    open_flips()           [(key, flip), ...] still waiting for players
+
+MemoryFlipStore keeps them in a dict of the bot process. PostgresFlipStore
+keeps them in the flips and flip_participants tables, so they survive
+restarts and can be shared by several bot workers.
+"""
+
+import db
+
+
+class MemoryFlipStore:
+    def __init__(self):
+        self.flips = {}
+
+    async def create(self, key, flip):
+        self.flips[key] = flip
+
+    async def get(self, key):
+        return self.flips.get(key)
+
+    async def join(self, key, user_id, username):
+        flip = self.flips.get(key)
+        if flip is None:
+            return "missing", None
+        if user_id in [p[0] for p in flip["participants"]]:
+            return "already", flip
+        if len(flip["participants"]) >= flip["max"]:
+            return "full", flip
+        flip["participants"].append((user_id, username))
+        return "joined", flip
+
+    async def take(self, key):
+        return self.flips.pop(key, None)
+
+    async def open_flips(self):
+        return list(self.flips.items())
+
+
+class PostgresFlipStore:
+    async def create(self, key, flip):
+        async with db.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO flips (
+                    chat_id, message_id, creator, sats, max_participants, is_giveflip, start_time,
+                    announcement_id, seed
+                )
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                """,
+                key[0],
+                key[1],
+                flip["creator"],
+                flip["sats"],
+                flip["max"],
+                flip["is_giveflip"],
+                flip["start_time"],
+                flip["announcement_id"],
+                flip.get("seed"),
+            )
+
+    async def get(self, key):
+        async with db.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT * FROM flips WHERE chat_id = $1 AND message_id = $2", *key
+            )
+            if row is None:
+                return None
+            return await self._with_participants(conn, row)
+
+    async def join(self, key, user_id, username):
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                # The row lock serialises joins on one flip across workers
+                row = await conn.fetchrow(
+                    "SELECT * FROM flips WHERE chat_id = $1 AND message_id = $2 FOR UPDATE", *key
+                )
+                if row is None:
+                    return "missing", None
+                inserted = await conn.fetchval(
+                    """
+                    INSERT INTO flip_participants (chat_id, message_id, user_id, username, position)
+                    SELECT $1, $2, $3, $4, COUNT(*) FROM flip_participants
+                    WHERE chat_id = $1 AND message_id = $2
+                    HAVING COUNT(*) < $5
+                    ON CONFLICT DO NOTHING
+                    RETURNING position
+                    """,
+                    key[0],
+                    key[1],
+                    user_id,
+                    username,
+                    row["max_participants"],
+                )
+                flip = await self._with_participants(conn, row)
+        if inserted is not None:
+            return "joined", flip
+        if user_id in [p[0] for p in flip["participants"]]:
+            return "already", flip
+        return "full", flip
+
+    async def take(self, key):
+        async with db.acquire() as conn:
+            # The participants CTE reads the snapshot from before the
+            # cascading delete
+            row = await conn.fetchrow(
+                """
+                WITH p AS (
+                    SELECT user_id, username, position FROM flip_participants
+                    WHERE chat_id = $1 AND message_id = $2
+                ), f AS (
+                    DELETE FROM flips WHERE chat_id = $1 AND message_id = $2 RETURNING *
+                )
+                SELECT f.*,
+                    ARRAY(SELECT user_id FROM p ORDER BY position) AS user_ids,
+                    ARRAY(SELECT username FROM p ORDER BY position) AS usernames
+                FROM f
+                """,
+                *key,
+            )
+        if row is None:
+            return None
+        return self._flip(row, list(zip(row["user_ids"], row["usernames"])))
+
+    async def open_flips(self):
+        async with db.acquire() as conn:
+            rows = await conn.fetch("SELECT * FROM flips")
+            participants = await conn.fetch(
+                "SELECT chat_id, message_id, user_id, username FROM flip_participants ORDER BY position"
+            )
+        flips = {(row["chat_id"], row["message_id"]): self._flip(row, []) for row in rows}
+        for p in participants:
+            flip = flips.get((p["chat_id"], p["message_id"]))
+            if flip is not None:
+                flip["participants"].append((p["user_id"], p["username"]))
+        return list(flips.items())
+
+    async def _with_participants(self, conn, row):
+        participants = await conn.fetch(
+            """
+            SELECT user_id, username FROM flip_participants
+            WHERE chat_id = $1 AND message_id = $2 ORDER BY position
+            """,
+            row["chat_id"],
+            row["message_id"],
+        )
+        return self._flip(row, [(p["user_id"], p["username"]) for p in participants])
+
+    @staticmethod
+    def _flip(row, participants):
+        return {
+            "creator": row["creator"],
+            "sats": row["sats"],
+            "max": row["max_participants"],
+            "participants": participants,
+            "start_time": row["start_time"],
+            "is_giveflip": row["is_giveflip"],
+            "announcement_id": row["announcement_id"],
+            "seed": row["seed"],
+        }
+
+
+def create_store(kind):
+    if kind == "memory":
+        return MemoryFlipStore()
+    if kind == "postgres":
+        return PostgresFlipStore()
+    raise ValueError(f"Unknown flip store {kind!r}")
@@ -0,0 +1,105 @@
+"""Double-entry ledger in the transactions table.
+
+Every change to a balance is recorded as an entry: rows sharing an
+entry_id whose amounts sum to zero. User accounts are Telegram user ids.
+The system accounts below are negative so they never collide with them.
+
+    deposit               user +a, DEPOSITS -a
+    coinflip / giveflip   one row per player, losers -, winner +
+    withdrawal            user -(sats + reserve), PENDING +(sats + reserve)
+    withdrawal sent       PENDING -(sats + reserve), WITHDRAWN +sats,
+                          FEES +fee, user +(reserve - fee), and if the
+                          fee share was over the reserve, FEES +excess,
+                          HOUSE -excess
+    withdrawal failed     PENDING -(sats + reserve), user +(sats + reserve)
+
+The ledger is append-only. balances is its projection for user accounts,
+updated in the same statement that appends the rows, so
+balance == SUM(amount) for every user and the wallet should hold the
+users' balances plus what is pending withdrawal.
+
+Rows are written by settlement.py, withdrawals.py and the deposit
+checker. This module reads them.
+"""
+
+from datetime import timedelta
+
+DEPOSITS = -1  # bitcoin received into the wallet
+WITHDRAWN = -2  # bitcoin paid out
+FEES = -3  # network fees paid on withdrawals
+PENDING = -4  # reserved by queued withdrawals
+OPENING = -5  # balances from before the ledger, see schema.sql
+HOUSE = -6  # withdrawal fees the house paid beyond the users' reserves
+
+HISTORY_PAGE_SIZE = 10
+
+# Only rows older than this are folded into a checkpoint, so a statement
+# still committing with a lower id cannot be skipped
+CHECKPOINT_LAG = timedelta(minutes=5)
+
+RECONCILE = """
+WITH last AS (
+    SELECT through_id, total, users, pending FROM ledger_checkpoints
+    ORDER BY through_id DESC LIMIT 1
+), start AS (
+    SELECT COALESCE((SELECT through_id FROM last), 0) AS id
+), stop AS (
+    SELECT MAX(t.id) AS id FROM transactions t, start
+    WHERE t.id > start.id AND t.created_at < now() - $2::interval
+), tail AS (
+    SELECT
+        COALESCE(SUM(t.amount) FILTER (WHERE t.id <= stop.id), 0) AS total_old,
+        COALESCE(SUM(t.amount) FILTER (WHERE t.id <= stop.id AND t.user_id >= 0), 0) AS users_old,
+        COALESCE(SUM(t.amount) FILTER (WHERE t.id <= stop.id AND t.user_id = $1), 0) AS pending_old,
+        COALESCE(SUM(t.amount), 0) AS total,
+        COALESCE(SUM(t.amount) FILTER (WHERE t.user_id >= 0), 0) AS users,
+        COALESCE(SUM(t.amount) FILTER (WHERE t.user_id = $1), 0) AS pending
+    FROM transactions t, start, stop
+    WHERE t.id > start.id
+), checkpoint AS (
+    INSERT INTO ledger_checkpoints (through_id, total, users, pending)
+    SELECT stop.id,
+        COALESCE(last.total, 0) + tail.total_old,
+        COALESCE(last.users, 0) + tail.users_old,
+        COALESCE(last.pending, 0) + tail.pending_old
+    FROM stop CROSS JOIN tail LEFT JOIN last ON true
+    WHERE stop.id IS NOT NULL
+    ON CONFLICT (through_id) DO NOTHING
+)
+SELECT
+    COALESCE(last.total, 0) + tail.total AS total,
+    COALESCE(last.users, 0) + tail.users AS users,
+    COALESCE(last.pending, 0) + tail.pending AS pending,
+    (SELECT COALESCE(SUM(balance), 0) FROM balances) AS balances
+FROM tail LEFT JOIN last ON true
+"""
+
+
+async def history(conn, user_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """The user's ledger rows, newest first, older than id `before` if given"""
+    return await conn.fetch(
+        """
+        SELECT id, type, amount, txid, ref, created_at FROM transactions
+        WHERE user_id = $1 AND ($2::bigint IS NULL OR id < $2)
+        ORDER BY id DESC LIMIT $3
+        """,
+        user_id,
+        before,
+        limit,
+    )
+
+
+async def reconcile(conn, wallet_sats=None):
+    """Ledger totals, checked against the balances projection and the wallet.
+
+    Sums the rows since the last checkpoint on top of it and stores a new
+    checkpoint, so each run reads only what was appended since the last
+    one. Returns a dict with total (must be 0), users, pending, balances
+    (must equal users) and, given the wallet balance, wallet_difference
+    (wallet_sats - users - pending, 0 when everything is accounted for).
+    """
+    row = await conn.fetchrow(RECONCILE, PENDING, CHECKPOINT_LAG)
+    result = {key: int(value) for key, value in row.items()}
+    if wallet_sats is not None:
+        result["wallet_difference"] = wallet_sats - result["users"] - result["pending"]
+    return result
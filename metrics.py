@@ -0,0 +1,226 @@
+"""Prometheus style metrics served over a local HTTP endpoint.
+
+Modules declare their metrics at import time and update them inline:
+
+    RPC_SECONDS = metrics.Histogram("rpc_call_seconds", "bitcoind RPC latency", ["method"])
+    RPC_SECONDS.observe(elapsed, method="getnewaddress")
+
+Gauges can also be computed at scrape time with set_function(). serve()
+starts an asyncio server answering GET /metrics in the Prometheus text
+format. Everything runs on the event loop, so no locking is needed.
+
+instrument_handlers() wraps every handler registered on a
+telegram.ext.Application so its latency and exceptions are recorded
+under the command or callback name.
+"""
+
+import asyncio
+import bisect
+import functools
+import logging
+import math
+import time
+
+from structured_log import event
+
+# Seconds, roughly a database round trip up to a slow Telegram call
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{v}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # label values -> value
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[n] for n in self.labelnames)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _labels(self.labelnames, key), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.function = None
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Reads the value(s) at scrape time. With labels, function returns {label values: value}."""
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                values = self.function()
+            except Exception as e:
+                logging.warning("Could not read gauge %s: %s", self.name, e, extra=event("metrics_error"))
+                return
+            self.values = values if self.labelnames else {(): values}
+        yield from super().samples()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            # counts per bucket plus +Inf, then sum
+            series = self.values[key] = [0] * (len(self.buckets) + 1) + [0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                le = (("le", _number(bound)),)
+                yield f"{self.name}_bucket", _labels(self.labelnames, key, le), cumulative
+            yield f"{self.name}_sum", _labels(self.labelnames, key), series[-1]
+            yield f"{self.name}_count", _labels(self.labelnames, key), cumulative
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, **self.labels)
+
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # headers
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    """Starts answering GET /metrics on host:port, returns the asyncio server"""
+    server = await asyncio.start_server(_handle, host, port)
+    logging.info("Serving metrics on %s:%s/metrics", host, port, extra=event("metrics", host=host, port=port))
+    return server
+
+
+HANDLER_SECONDS = Histogram("handler_seconds", "Time spent in bot handlers", ["handler"])
+HANDLER_ERRORS = Counter("handler_errors_total", "Exceptions raised by bot handlers", ["handler", "error"])
+
+
+def handler_name(handler):
+    commands = getattr(handler, "commands", None)
+    if commands:
+        return "/" + min(commands)
+    return getattr(handler.callback, "__name__", type(handler).__name__)
+
+
+def timed_handler(name, callback):
+    # Imported here so the deposit checker can use metrics without loading telegram
+    from telegram.ext import ApplicationHandlerStop
+
+    if getattr(callback, "_timed", False):
+        return callback
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except ApplicationHandlerStop:
+            raise  # flow control, e.g. the rate limiter, not a failure
+        except Exception as e:
+            HANDLER_ERRORS.inc(handler=name, error=type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, handler=name)
+
+    wrapper._timed = True
+    return wrapper
+
+
+def instrument_handlers(app):
+    """Times every handler registered on the Application, call it once they are all added"""
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = timed_handler(handler_name(handler), handler.callback)
@@ -0,0 +1,69 @@
+"""Per player totals of settled flips, for /stats and /top.
+
+player_stats has one row per player and chat, plus one per player with
+chat_id GLOBAL (0) covering every chat. settle_flip() adds each settled
+flip to both in the statement that moves the sats, so the totals are
+always in step with the balances:
+
+    played       flips joined
+    won          flips won
+    wagered      sats put at stake (the entry, or the gift for a giver)
+    net          sats won minus sats lost
+    biggest_win  largest net gain from a single flip
+
+Leaderboards read the (chat_id, net DESC) index, so the top N of a chat
+costs the same however many players and flips it has. Both reads go
+through a StatsCache with a short TTL.
+"""
+
+import time
+from collections import OrderedDict
+
+GLOBAL = 0
+TOP_SIZE = 10
+
+
+async def player(conn, user_id, chat_id=None):
+    """{chat_id: row} of the user's global totals and, given a chat, those in it"""
+    rows = await conn.fetch(
+        """
+        SELECT chat_id, played, won, wagered, net, biggest_win FROM player_stats
+        WHERE user_id = $1 AND chat_id = ANY($2::bigint[])
+        """,
+        user_id,
+        [GLOBAL] if chat_id is None else [GLOBAL, chat_id],
+    )
+    return {row["chat_id"]: row for row in rows}
+
+
+async def top(conn, chat_id=GLOBAL, limit=TOP_SIZE):
+    """The chat's players with the highest net winnings, best first"""
+    return await conn.fetch(
+        """
+        SELECT user_id, name, played, won, net FROM player_stats
+        WHERE chat_id = $1 ORDER BY net DESC LIMIT $2
+        """,
+        chat_id,
+        limit,
+    )
+
+
+class StatsCache:
+    """Query results by key for `ttl` seconds, at most max_size of them"""
+
+    def __init__(self, ttl=30, max_size=10_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # key -> (value, expires_at)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, key, value):
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
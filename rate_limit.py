@@ -0,0 +1,82 @@
+"""Token bucket rate limits per user and per chat, for each command.
+
+Limits are configured per command (or callback prefix such as "join") as
+a list of (scope, per_minute, burst), scope being "user" or "chat":
+
+    limiter = RateLimiter({"coinflip": [("user", 6, 3), ("chat", 30, 10)]})
+    wait = limiter.check("coinflip", user_id, chat_id)  # None, or seconds to wait
+
+A call is allowed only if every bucket it touches has a token left, and
+only then are the tokens taken. Buckets are stored as one float each, the
+time at which the bucket will be full again (GCRA, equivalent to a token
+bucket). A full bucket is the same as a missing one, so buckets are
+dropped once they refill. They sit in an OrderedDict from least to most
+recently used, and each check evicts from the front while the oldest
+bucket is full. max_buckets caps the size even when everything is in
+use.
+"""
+
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    def __init__(self, limits, default=(), max_buckets=1_000_000):
+        # name -> [(scope, seconds per token, seconds of burst on top)]
+        self.limits = {name: self._compile(rules) for name, rules in limits.items()}
+        self.default = self._compile(default)
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()  # (scope, id, name) -> time the bucket is full again
+        self.throttled = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _compile(rules):
+        return [(scope, 60 / per_minute, (burst - 1) * 60 / per_minute) for scope, per_minute, burst in rules]
+
+    def check(self, name, user_id, chat_id, now=None):
+        """Takes a token from each of the call's buckets, or returns the seconds until it could"""
+        rules = self.limits.get(name, self.default)
+        if not rules:
+            return None
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+        taken = []
+        wait = 0
+        for scope, interval, tolerance in rules:
+            key = (scope, user_id if scope == "user" else chat_id, name)
+            full_at = max(self.buckets.get(key, now), now)
+            if full_at - now > tolerance:
+                wait = max(wait, full_at - now - tolerance)
+            else:
+                taken.append((key, full_at + interval))
+        if wait:
+            self.throttled += 1
+            return wait
+        for key, full_at in taken:
+            self.buckets[key] = full_at
+            self.buckets.move_to_end(key)
+        return None
+
+    def _evict(self, now):
+        buckets = self.buckets
+        while buckets:
+            key, full_at = next(iter(buckets.items()))
+            if full_at > now and len(buckets) <= self.max_buckets:
+                return
+            del buckets[key]
+            self.evicted += 1
+
+    def stats(self):
+        return {"buckets": len(self.buckets), "throttled": self.throttled, "evicted": self.evicted}
+
+
+def update_command(update):
+    """The name limits are looked up by: the command, or the callback data prefix"""
+    if update.callback_query is not None and update.callback_query.data:
+        return update.callback_query.data.split("_", 1)[0]
+    message = update.effective_message
+    if message is not None and message.text and message.text.startswith("/"):
+        words = message.text[1:].split(None, 1)
+        return words[0].split("@", 1)[0].lower() if words else None
+    return None
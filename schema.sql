@@ -0,0 +1,157 @@
+-- Schema additions on top of the original balances, addresses and
+-- transactions tables. Safe to run more than once:
+--   psql coinflipper -f schema.sql
+
+-- Deposits are deduplicated by output
+CREATE UNIQUE INDEX IF NOT EXISTS transactions_txid_vout ON transactions (txid, vout);
+CREATE INDEX IF NOT EXISTS addresses_address ON addresses (address);
+
+-- Last block hash each incremental scanner has processed
+CREATE TABLE IF NOT EXISTS scanner_state (
+    name TEXT PRIMARY KEY,
+    block_hash TEXT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Open flips, used when the bot runs with FLIP_STORE = "postgres"
+CREATE TABLE IF NOT EXISTS flips (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    creator BIGINT NOT NULL,
+    sats BIGINT NOT NULL,
+    max_participants INT NOT NULL,
+    is_giveflip BOOLEAN NOT NULL,
+    start_time TIMESTAMP NOT NULL,
+    announcement_id BIGINT NOT NULL,
+    seed BYTEA,
+    PRIMARY KEY (chat_id, message_id)
+);
+ALTER TABLE flips ADD COLUMN IF NOT EXISTS seed BYTEA;
+
+CREATE TABLE IF NOT EXISTS flip_participants (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    username TEXT NOT NULL,
+    position INT NOT NULL,
+    PRIMARY KEY (chat_id, message_id, user_id),
+    FOREIGN KEY (chat_id, message_id) REFERENCES flips ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS flip_participants_position ON flip_participants (chat_id, message_id, position);
+
+-- Settled flips with their revealed seed, enough to recompute the winner
+CREATE TABLE IF NOT EXISTS flip_results (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    seed BYTEA NOT NULL,
+    commitment TEXT NOT NULL,
+    participants BIGINT[] NOT NULL,
+    winners BIGINT[] NOT NULL,
+    settled_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (chat_id, message_id)
+);
+
+-- Withdrawal queue, paid out in batches by deposit_checker.py
+CREATE TABLE IF NOT EXISTS withdrawals (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    address TEXT NOT NULL,
+    sats BIGINT NOT NULL,
+    fee_rate NUMERIC NOT NULL,
+    reserved_fee BIGINT NOT NULL,
+    fee_sats BIGINT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    txid TEXT,
+    attempts INT NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS withdrawals_pending ON withdrawals (id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS withdrawals_user ON withdrawals (user_id, id);
+
+-- Double-entry ledger, see ledger.py. The transactions table becomes the
+-- ledger: every row belongs to an entry whose amounts sum to zero.
+CREATE SEQUENCE IF NOT EXISTS ledger_entries;
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS id BIGSERIAL;
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS entry_id BIGINT NOT NULL DEFAULT nextval('ledger_entries');
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS ref TEXT;
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+CREATE UNIQUE INDEX IF NOT EXISTS transactions_id ON transactions (id);
+-- /history pages through a user's rows by id
+CREATE INDEX IF NOT EXISTS transactions_user_id ON transactions (user_id, id);
+
+-- Running totals up to a ledger row, reconciliation only sums what came after
+CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+    through_id BIGINT PRIMARY KEY,
+    total BIGINT NOT NULL,
+    users BIGINT NOT NULL,
+    pending BIGINT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- One-time migration of rows from before the ledger, skipped once the
+-- ledger has been reconciled. Old deposits get their counter-leg...
+INSERT INTO transactions (user_id, type, amount, entry_id, ref)
+SELECT -1, 'deposit', -t.amount, t.entry_id, t.txid || ':' || t.vout
+FROM transactions t
+WHERE t.type = 'deposit' AND t.user_id >= 0
+    AND NOT EXISTS (SELECT 1 FROM ledger_checkpoints)
+    AND NOT EXISTS (SELECT 1 FROM transactions c WHERE c.entry_id = t.entry_id AND c.user_id = -1);
+
+-- ...and balances the ledger does not explain (flips settled before they
+-- were recorded, amounts reserved by queued withdrawals) one opening entry
+WITH drift AS (
+    SELECT b.user_id, b.balance - COALESCE(t.amount, 0) AS amount
+    FROM balances b
+    LEFT JOIN (
+        SELECT user_id, SUM(amount) AS amount FROM transactions WHERE user_id >= 0 GROUP BY user_id
+    ) t USING (user_id)
+    WHERE b.balance <> COALESCE(t.amount, 0)
+    UNION ALL
+    SELECT -4, SUM(sats + reserved_fee) FROM withdrawals
+    WHERE status IN ('pending', 'sending', 'unknown')
+    HAVING COUNT(*) > 0
+), entry AS (
+    SELECT nextval('ledger_entries') AS id
+    WHERE NOT EXISTS (SELECT 1 FROM ledger_checkpoints)
+        AND NOT EXISTS (SELECT 1 FROM transactions WHERE user_id = -5)
+        AND EXISTS (SELECT 1 FROM drift)
+)
+INSERT INTO transactions (user_id, type, amount, entry_id)
+SELECT drift.user_id, 'opening', drift.amount, entry.id FROM drift, entry
+UNION ALL
+SELECT -5, 'opening', -SUM(drift.amount), entry.id FROM drift, entry GROUP BY entry.id;
+
+-- Deposit addresses generated ahead of time, see address_pool.py.
+-- user_id is set when /address claims one.
+CREATE TABLE IF NOT EXISTS address_pool (
+    id BIGSERIAL PRIMARY KEY,
+    address TEXT NOT NULL UNIQUE,
+    user_id BIGINT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    claimed_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS address_pool_unclaimed ON address_pool (id) WHERE user_id IS NULL;
+
+-- Addresses per user, kept up to date by the claiming statement so /address
+-- does not count them
+ALTER TABLE balances ADD COLUMN IF NOT EXISTS address_count INT NOT NULL DEFAULT 0;
+UPDATE balances b SET address_count = a.n
+FROM (SELECT user_id, COUNT(*) AS n FROM addresses GROUP BY user_id) a
+WHERE b.user_id = a.user_id AND b.address_count <> a.n;
+
+-- Per player totals of settled flips, see player_stats.py. chat_id 0 holds
+-- each player's totals over all chats.
+CREATE TABLE IF NOT EXISTS player_stats (
+    chat_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    name TEXT,
+    played BIGINT NOT NULL DEFAULT 0,
+    won BIGINT NOT NULL DEFAULT 0,
+    wagered BIGINT NOT NULL DEFAULT 0,
+    net BIGINT NOT NULL DEFAULT 0,
+    biggest_win BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS player_stats_top ON player_stats (chat_id, net DESC);
@@ -0,0 +1,119 @@
+"""Settles a finished flip in one database round trip.
+
+settle_flip() locks every participant's balance row, checks that
+everyone who has to pay can, moves the sats and writes one ledger row
+per participant, all in a single statement. If anyone is short nothing
+is changed and their user ids are returned. The same statement adds the
+flip to the totals in player_stats of every participant, and of a
+giveflip's creator, who is only counted as playing if they joined. Given
+the flip's key it also records the revealed seed and winner in
+flip_results and counts the flip in the chat's totals. Given a notify
+channel it sends the changed user ids on it, so other bot processes drop
+their cached balances.
+"""
+
+import fair_random
+
+SETTLE_FLIP = """
+WITH entries AS (
+    SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[]) AS e(user_id, delta, required)
+), locked AS (
+    SELECT b.user_id, b.balance FROM balances b
+    WHERE b.user_id IN (SELECT user_id FROM entries)
+    ORDER BY b.user_id
+    FOR UPDATE
+), short AS (
+    SELECT e.user_id FROM entries e LEFT JOIN locked l USING (user_id)
+    WHERE l.balance IS NULL OR l.balance < e.required
+), moved AS (
+    UPDATE balances b SET balance = b.balance + e.delta
+    FROM entries e
+    WHERE b.user_id = e.user_id AND NOT EXISTS (SELECT 1 FROM short)
+    RETURNING b.user_id, b.balance
+), ledger AS (
+    INSERT INTO transactions (user_id, type, amount, entry_id, ref)
+    SELECT user_id, $4, delta, (SELECT nextval('ledger_entries')), $11 FROM entries
+    WHERE NOT EXISTS (SELECT 1 FROM short)
+), result AS (
+    INSERT INTO flip_results (chat_id, message_id, seed, commitment, participants, winners)
+    SELECT $5, $6, $7, $8, $9, ARRAY[$10::bigint]
+    WHERE $5::bigint IS NOT NULL AND NOT EXISTS (SELECT 1 FROM short)
+), stats AS (
+    INSERT INTO player_stats AS s (chat_id, user_id, name, played, won, wagered, net, biggest_win)
+    SELECT c.chat_id, u.user_id, u.name, u.played, (u.user_id = $10)::int,
+        u.wagered, u.net, CASE WHEN u.user_id = $10 THEN GREATEST(u.net, 0) ELSE 0 END
+    FROM (
+        -- Everyone who joined, and a giveflip's creator even if they did not
+        SELECT COALESCE(p.user_id, e.user_id) AS user_id, p.name, (p.user_id IS NOT NULL)::int AS played,
+            COALESCE(e.required, 0) AS wagered, COALESCE(e.delta, 0) AS net
+        FROM unnest($9::bigint[], $13::text[]) AS p(user_id, name)
+        FULL JOIN entries e ON e.user_id = p.user_id
+    ) u
+    CROSS JOIN (VALUES (0::bigint), ($14::bigint)) AS c(chat_id)
+    WHERE c.chat_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM short)
+    ORDER BY c.chat_id, u.user_id
+    ON CONFLICT (chat_id, user_id) DO UPDATE SET
+        name = COALESCE(EXCLUDED.name, s.name),
+        played = s.played + EXCLUDED.played,
+        won = s.won + EXCLUDED.won,
+        wagered = s.wagered + EXCLUDED.wagered,
+        net = s.net + EXCLUDED.net,
+        biggest_win = GREATEST(s.biggest_win, EXCLUDED.biggest_win)
+)
+SELECT
+    ARRAY(SELECT user_id FROM short) AS short,
+    ARRAY(SELECT user_id FROM moved) AS user_ids,
+    ARRAY(SELECT balance FROM moved) AS balances,
+    (SELECT COUNT(*) FROM (
+        SELECT pg_notify($12, user_id::text) FROM moved WHERE $12::text IS NOT NULL
+    ) n) AS notified
+"""
+
+
+def flip_entries(flip, winner_id):
+    """Balance changes and required funds per user as {user_id: [delta, required]}"""
+    entries = {}
+
+    def add(user_id, delta, required):
+        entry = entries.setdefault(user_id, [0, 0])
+        entry[0] += delta
+        entry[1] += required
+
+    sats = flip["sats"]
+    if flip["is_giveflip"]:
+        add(flip["creator"], -sats, sats)
+        add(winner_id, sats, 0)
+    else:
+        for user_id, _ in flip["participants"]:
+            add(user_id, -sats, sats)
+        add(winner_id, sats * len(flip["participants"]), 0)
+    return entries
+
+
+async def settle_flip(conn, flip, winner_id, key=None, notify=None):
+    """Pays out a flip. Returns (short_user_ids, {user_id: new_balance}).
+
+    short_user_ids is empty when the flip was settled, otherwise it lists
+    the users lacking funds and no balance was touched.
+    """
+    entries = flip_entries(flip, winner_id)
+    user_ids = list(entries)
+    seed = flip.get("seed") if key is not None else None
+    row = await conn.fetchrow(
+        SETTLE_FLIP,
+        user_ids,
+        [entries[u][0] for u in user_ids],
+        [entries[u][1] for u in user_ids],
+        "giveflip" if flip["is_giveflip"] else "coinflip",
+        key[0] if seed is not None else None,
+        key[1] if seed is not None else None,
+        seed,
+        fair_random.commitment(seed) if seed is not None else None,
+        [user_id for user_id, _ in flip["participants"]],
+        winner_id,
+        f"flip:{key[0]}:{key[1]}" if key is not None else None,
+        notify,
+        [name for _, name in flip["participants"]],
+        key[0] if key is not None else None,
+    )
+    return list(row["short"]), dict(zip(row["user_ids"], row["balances"]))
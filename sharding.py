@@ -0,0 +1,265 @@
+"""Runs the bot as worker processes, each owning a shard of the chats.
+
+A Supervisor receives updates from Telegram (polling or webhook, through
+its own Application) and routes each one to a worker by shard_of() its
+chat id:
+
+    supervisor --route--> inbox 0 --> worker 0 (Application without updater)
+               --route--> inbox 1 --> worker 1
+               ...
+
+All updates of a chat land in the same worker, in the order Telegram sent
+them, so open flips, their locks and the edit scheduler stay local to the
+worker. Balances are shared through the database as before.
+
+Workers report their health over a status queue every HEALTH_INTERVAL
+seconds. The supervisor restarts workers that died and exposes one set of
+shard_* gauges per worker.
+
+Draining sends each worker a None on its inbox. The worker stops taking
+updates, finishes the ones it has and shuts its Application down. This
+happens on shutdown and on reshard(). While a reshard drains the old
+workers, new updates are buffered and routed to the new workers once
+they are up.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import zlib
+
+from telegram import Update
+
+import metrics
+from structured_log import event
+
+HEALTH_INTERVAL = 5  # seconds between worker status reports
+DRAIN_TIMEOUT = 30  # seconds a worker gets to finish its updates before it is killed
+
+SHARD_ALIVE = metrics.Gauge("shard_alive", "1 while the shard's worker process is running", ["shard"])
+SHARD_BACKLOG = metrics.Gauge("shard_backlog", "Updates routed to the shard and not yet handled", ["shard"])
+SHARD_OPEN_FLIPS = metrics.Gauge("shard_open_flips", "Open flips in the shard's worker", ["shard"])
+SHARD_REPORT_AGE = metrics.Gauge(
+    "shard_report_age_seconds", "Seconds since the shard's worker last reported", ["shard"]
+)
+SHARD_RESTARTS = metrics.Counter("shard_restarts_total", "Workers restarted after dying", ["shard"])
+UPDATES_ROUTED = metrics.Counter("updates_routed_total", "Updates routed to each shard", ["shard"])
+
+
+def shard_of(chat_id, shards):
+    """The shard owning chat_id, stable across processes and restarts"""
+    return zlib.crc32(chat_id.to_bytes(8, "big", signed=True)) % shards
+
+
+def update_chat_id(update):
+    """The id updates are sharded by: the chat, else the user, else 0"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+
+class Supervisor:
+    """Starts `shards` processes running target(shard, shards, inbox, status)"""
+
+    def __init__(self, target, shards):
+        self.target = target
+        self.shards = shards
+        self.context = multiprocessing.get_context("spawn")
+        self.status = self.context.Queue()
+        self.workers = []  # [process, inbox] per shard
+        self.health = {}  # shard -> last status report, plus "received_at"
+        self.buffer = None  # (update, chat_id) held back while resharding
+        self._monitor = None
+        self._pending_reshard = None
+        self._resharding = asyncio.Lock()
+        SHARD_ALIVE.set_function(
+            lambda: {(str(s),): int(p.is_alive()) for s, (p, _) in enumerate(self.workers)}
+        )
+        SHARD_BACKLOG.set_function(
+            lambda: {(str(s),): inbox.qsize() + self.health.get(s, {}).get("backlog", 0)
+                     for s, (_, inbox) in enumerate(self.workers)}
+        )
+        SHARD_OPEN_FLIPS.set_function(
+            lambda: {(str(s),): h.get("open_flips", 0) for s, h in self.health.items()}
+        )
+        SHARD_REPORT_AGE.set_function(
+            lambda: {(str(s),): time.monotonic() - h["received_at"] for s, h in self.health.items()}
+        )
+
+    def _spawn(self, shard, inbox):
+        process = self.context.Process(
+            target=self.target,
+            args=(shard, self.shards, inbox, self.status),
+            name=f"shard-{shard}",
+        )
+        process.start()
+        logging.info(
+            "Started worker %s/%s with pid %s", shard, self.shards, process.pid,
+            extra=event("shard_started", shard=shard, shards=self.shards, pid=process.pid),
+        )
+        return process
+
+    def _start_workers(self):
+        self.workers = []
+        for shard in range(self.shards):
+            inbox = self.context.Queue()
+            self.workers.append([self._spawn(shard, inbox), inbox])
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._start_workers()
+        self._monitor = loop.create_task(self._watch())
+        loop.add_signal_handler(signal.SIGHUP, self._reshard_soon, 0)
+        loop.add_signal_handler(signal.SIGUSR1, self._reshard_soon, 1)
+        loop.add_signal_handler(signal.SIGUSR2, self._reshard_soon, -1)
+
+    def _reshard_soon(self, change):
+        # SIGHUP restarts every worker (e.g. after a deploy), SIGUSR1/SIGUSR2 add or remove one
+        self._pending_reshard = asyncio.get_running_loop().create_task(self.reshard(max(1, self.shards + change)))
+
+    async def route(self, update, context):
+        """Handler for every update the supervisor's Application receives"""
+        data, chat_id = update.to_dict(), update_chat_id(update)
+        if self.buffer is not None:
+            self.buffer.append((data, chat_id))
+            return
+        self._put(data, chat_id)
+
+    def _put(self, data, chat_id):
+        shard = shard_of(chat_id, self.shards)
+        self.workers[shard][1].put(data)
+        UPDATES_ROUTED.inc(shard=str(shard))
+
+    def _read_status(self):
+        while True:
+            try:
+                report = self.status.get_nowait()
+            except queue.Empty:
+                return
+            if report["shards"] == self.shards:  # drop late reports of drained workers
+                self.health[report["shard"]] = dict(report, received_at=time.monotonic())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL)
+            self._read_status()
+            if self._resharding.locked():
+                continue
+            for shard, (process, inbox) in enumerate(self.workers):
+                if process.is_alive():
+                    continue
+                # The dead worker may have held the inbox's read lock, so
+                # its replacement gets a new one and the backlog is lost
+                lost = inbox.qsize()
+                logging.error(
+                    "Worker %s exited with %s, restarting it, %s updates lost", shard, process.exitcode, lost,
+                    extra=event("shard_died", shard=shard, exitcode=process.exitcode, lost=lost),
+                )
+                SHARD_RESTARTS.inc(shard=str(shard))
+                inbox = self.context.Queue()
+                self.workers[shard] = [self._spawn(shard, inbox), inbox]
+            reports = {s: {k: v for k, v in h.items() if k != "received_at"} for s, h in self.health.items()}
+            logging.info(
+                "%s of %s workers reporting", len(reports), self.shards,
+                extra=event("shard_health", shards=reports),
+            )
+
+    async def drain(self, timeout=DRAIN_TIMEOUT):
+        """Lets every worker finish its updates and exit"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        for _, inbox in self.workers:
+            inbox.put(None)
+        await asyncio.gather(*(loop.run_in_executor(None, p.join, timeout) for p, _ in self.workers))
+        for shard, (process, inbox) in enumerate(self.workers):
+            if process.is_alive():
+                logging.warning(
+                    "Worker %s did not drain within %ss, killing it", shard, timeout,
+                    extra=event("shard_killed", shard=shard),
+                )
+                process.kill()
+                process.join()
+            inbox.close()
+        logging.info(
+            "Drained %s workers", len(self.workers),
+            extra=event(
+                "shards_drained", shards=len(self.workers), latency_ms=round((time.perf_counter() - started) * 1000, 2)
+            ),
+        )
+        self.workers = []
+        self.health.clear()
+
+    async def reshard(self, shards):
+        """Drains the workers and starts `shards` new ones, holding updates meanwhile"""
+        async with self._resharding:
+            logging.info(
+                "Resharding from %s to %s workers", self.shards, shards,
+                extra=event("reshard", old=self.shards, new=shards),
+            )
+            self.buffer = []
+            try:
+                await self.drain()
+                self.shards = shards
+                self._start_workers()
+            finally:
+                buffered, self.buffer = self.buffer, None
+            for data, chat_id in buffered:
+                self._put(data, chat_id)
+
+    async def stop(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+        async with self._resharding:
+            await self.drain()
+        self.status.close()
+
+
+async def run_worker(app, shard, shards, inbox, status, stats):
+    """Feeds updates from `inbox` into the Application until a None arrives.
+
+    Runs the Application the way run_polling() would, without an updater:
+    post_init, start, then stop, post_stop, shutdown and post_shutdown once
+    drained. stats() returns extra fields for the health report.
+    """
+    loop = asyncio.get_running_loop()
+    received = 0
+
+    async def report():
+        while True:
+            status.put(dict(
+                stats(), shard=shard, shards=shards, pid=os.getpid(), received=received,
+                backlog=app.update_queue.qsize(),
+            ))
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    reporter = loop.create_task(report())
+    try:
+        while True:
+            data = await loop.run_in_executor(None, inbox.get)
+            if data is None:
+                break
+            await app.update_queue.put(Update.de_json(data, app.bot))
+            received += 1
+    finally:
+        reporter.cancel()
+        logging.info(
+            "Worker %s draining after %s updates", shard, received,
+            extra=event("shard_draining", shard=shard, received=received),
+        )
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
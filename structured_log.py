@@ -0,0 +1,117 @@
+"""JSON logging through a queue, written by a background thread.
+
+setup() replaces the root logger's handlers with a QueueHandler. Records
+are put on an in-memory queue as they are, unformatted, and a
+QueueListener thread formats them as one JSON object per line and writes
+them to a rotating file, so neither formatting nor a slow disk holds up
+the event loop.
+
+Call sites pass structured fields with extra=event(...):
+
+    logging.info("User %s joined flip %s", user_id, key,
+                 extra=event("join", user_id=user_id, chat_id=chat_id, flip=key))
+
+which is written as
+
+    {"ts": "...", "level": "INFO", "event": "join", "msg": "User 1 joined flip (-100, 5)",
+     "user_id": 1, "chat_id": -100, "flip": [-100, 5]}
+
+High volume events can be sampled: with sample_rates={"join_attempt": 10}
+one in ten join_attempt records below WARNING is kept, the rest are
+dropped before they are queued or formatted.
+"""
+
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+from datetime import datetime, timezone
+
+_listener = None
+
+
+def event(name, **fields):
+    """The extra= argument for a structured log record"""
+    return {"event": name, "fields": fields}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": getattr(record, "event", None),
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class EventSampler(logging.Filter):
+    """Keeps one in `rate` records of each sampled event below WARNING"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.counters = {name: itertools.count() for name in rates}
+        self.rates = rates
+
+    def filter(self, record):
+        name = getattr(record, "event", None)
+        if name not in self.rates or record.levelno >= logging.WARNING:
+            return True
+        return next(self.counters[name]) % self.rates[name] == 0
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The listener runs in this process, so the record can be queued
+        # as is and formatted by the listener thread instead of here
+        return record
+
+
+def setup(path, level=logging.INFO, max_bytes=50_000_000, backups=5, when=None, sample_rates=None):
+    """Routes all logging to `path` as JSON lines through a background thread.
+
+    The file rotates at max_bytes, or at `when` (e.g. "midnight") if given,
+    keeping `backups` old files. shutdown() runs at exit and flushes what
+    is still queued.
+    """
+    global _listener
+    shutdown()
+    if when is None:
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+    else:
+        file_handler = logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backups, utc=True)
+    file_handler.setFormatter(JsonFormatter())
+
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    if sample_rates:
+        handler.addFilter(EventSampler(sample_rates))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, file_handler)
+    _listener.start()
+
+
+def shutdown():
+    """Writes out queued records and stops the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown)
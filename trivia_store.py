@@ -0,0 +1,37 @@
+"""Trivia lines for /trivia, read from the file on first use.
+
+The lines are kept as one UTF-8 bytes object and an array of offsets
+into it rather than a list of str, so they cost a few bytes each beyond
+their text, and nothing is read until someone asks for trivia.
+"""
+
+import random
+from array import array
+
+
+class TriviaStore:
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.offsets = None  # start of each line in data, then len(data)
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+        self.data = b"".join(lines)
+        self.offsets = array("Q", [0])
+        for line in lines:
+            self.offsets.append(self.offsets[-1] + len(line))
+
+    def __len__(self):
+        if self.offsets is None:
+            self.load()
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.data[self.offsets[index]:self.offsets[index + 1]].decode()
+
+    def choice(self):
+        return self[random.randrange(len(self))]
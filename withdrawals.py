@@ -0,0 +1,356 @@
+"""Withdrawal queue, paid out in batches.
+
+The bot reserves a withdrawal against the user's balance right away:
+the amount plus a fee reserve sized for a transaction of its own. The
+deposit checker process collects pending withdrawals and pays them out
+in one multi-output `send`. A batch only holds withdrawals of the same
+fee rate, so nobody pays for someone else's. Each withdrawal is charged
+an even share of the batch fee (each adds one output), capped at its
+reserve, and the rest of the reserve is refunded. If a share is over the
+reserve, e.g. because the batch needed many inputs, the house pays the
+difference as a ledger entry from ledger.HOUSE.
+
+Statuses: pending -> sending -> sent. A batch bitcoind rejects goes back
+to pending until it has been tried max_attempts times, then it is failed
+and refunded. If we cannot tell whether a batch was broadcast (timeout,
+lost connection, crash while sending) its withdrawals are marked unknown
+and left for a human, never retried automatically.
+
+Each step that moves money is a ledger entry (see ledger.py) written in
+the same statement: the reservation moves sats to ledger.PENDING, a sent
+withdrawal moves them on to WITHDRAWN and FEES and refunds the rest, a
+failed one moves them back to the user.
+"""
+
+import logging
+import math
+import time
+from decimal import Decimal, InvalidOperation
+
+import db
+import ledger
+from balance_cache import BALANCE_CHANNEL
+from bitcoin_rpc import RPCError
+from coin_selection import InsufficientFunds, load_utxos, select_coins
+from structured_log import event
+
+WITHDRAWAL_CHANNEL = "withdrawal_requested"
+
+# Size of a one input, two output segwit transaction, the fee a withdrawal
+# would have paid on its own
+FEE_RESERVE_VBYTES = 150
+
+# sat/vB, bitcoind does not relay below MIN_FEE_RATE
+MIN_FEE_RATE = Decimal(1)
+MAX_FEE_RATE = Decimal(500)
+
+
+def check_fee_rate(fee_rate, max_fee_rate=MAX_FEE_RATE):
+    """fee_rate as a Decimal, ValueError unless it is from MIN_FEE_RATE to max_fee_rate"""
+    try:
+        rate = Decimal(fee_rate)
+    except (InvalidOperation, TypeError, ValueError):
+        raise ValueError("fee rate is not a number") from None
+    if not rate.is_finite() or not MIN_FEE_RATE <= rate <= max_fee_rate:
+        raise ValueError(f"fee rate must be between {MIN_FEE_RATE} and {max_fee_rate} sat/vB")
+    return rate
+
+
+def fee_reserve(fee_rate):
+    return math.ceil(Decimal(fee_rate) * FEE_RESERVE_VBYTES)
+
+
+async def request_withdrawal(conn, user_id, address, sats, fee_rate, notify=None, max_fee_rate=MAX_FEE_RATE):
+    """Reserves sats plus the fee reserve and queues the withdrawal.
+
+    Returns (withdrawal_id, new_balance), or None if the balance is too low.
+    Raises ValueError if the fee rate is out of range, see check_fee_rate().
+    Given a notify channel the user id is sent on it, see settle_flip().
+    """
+    fee_rate = check_fee_rate(fee_rate, max_fee_rate)
+    reserved_fee = fee_reserve(fee_rate)
+    row = await conn.fetchrow(
+        """
+        WITH debit AS (
+            UPDATE balances SET balance = balance - ($2::bigint + $5::bigint)
+            WHERE user_id = $1 AND balance >= $2::bigint + $5::bigint
+            RETURNING balance
+        ), queued AS (
+            INSERT INTO withdrawals (user_id, address, sats, fee_rate, reserved_fee)
+            SELECT $1, $3, $2, $4, $5 FROM debit
+            RETURNING id, nextval('ledger_entries') AS entry_id
+        ), entry AS (
+            INSERT INTO transactions (user_id, type, amount, entry_id, ref)
+            SELECT l.account, 'withdrawal', l.amount, q.entry_id, 'withdrawal:' || q.id
+            FROM queued q, (VALUES ($1::bigint, -($2::bigint + $5::bigint)), ($7::bigint, $2::bigint + $5::bigint))
+                AS l(account, amount)
+        )
+        SELECT queued.id, debit.balance, pg_notify($6, queued.id::text),
+            CASE WHEN $8::text IS NOT NULL THEN pg_notify($8, $1::text) END
+        FROM queued, debit
+        """,
+        user_id,
+        sats,
+        address,
+        fee_rate,
+        reserved_fee,
+        WITHDRAWAL_CHANNEL,
+        ledger.PENDING,
+        notify,
+    )
+    if row is None:
+        return None
+    return row["id"], row["balance"]
+
+
+async def recent_withdrawals(conn, user_id, limit=10):
+    return await conn.fetch(
+        """
+        SELECT id, address, sats, fee_sats, reserved_fee, status, txid, created_at
+        FROM withdrawals WHERE user_id = $1
+        ORDER BY id DESC LIMIT $2
+        """,
+        user_id,
+        limit,
+    )
+
+
+async def pending_summary(conn):
+    """(number of pending withdrawals, creation time of the oldest)"""
+    row = await conn.fetchrow(
+        "SELECT COUNT(*) AS n, MIN(created_at) AS oldest FROM withdrawals WHERE status = 'pending'"
+    )
+    return row["n"], row["oldest"]
+
+
+async def recover_interrupted(conn):
+    """Flags batches a previous run was sending when it stopped"""
+    rows = await conn.fetch(
+        """
+        UPDATE withdrawals SET status = 'unknown', error = 'interrupted while sending', updated_at = now()
+        WHERE status = 'sending' RETURNING id
+        """
+    )
+    for row in rows:
+        logging.error(
+            "Withdrawal %s was being sent when the checker stopped, check it manually", row["id"],
+            extra=event("withdrawal_interrupted", withdrawal_id=row["id"]),
+        )
+
+
+async def claim_batch(conn, max_size):
+    """Claims the oldest pending withdrawal and up to max_size - 1 more at its fee rate"""
+    return await conn.fetch(
+        """
+        UPDATE withdrawals SET status = 'sending', attempts = attempts + 1, updated_at = now()
+        WHERE id IN (
+            SELECT id FROM withdrawals
+            WHERE status = 'pending' AND fee_rate = (
+                SELECT fee_rate FROM withdrawals WHERE status = 'pending' ORDER BY id LIMIT 1
+            )
+            ORDER BY id LIMIT $1 FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+        """,
+        max_size,
+    )
+
+
+def prorate_fee(batch, fee_sats):
+    """Splits fee_sats evenly over the batch, the odd sats going to the oldest withdrawals"""
+    share, odd = divmod(fee_sats, len(batch))
+    return [share + (i < odd) for i in range(len(batch))]
+
+
+async def mark_sent(conn, batch, txid, shares):
+    """Marks the batch sent, charging each withdrawal its share of the fee up to its
+    reserve. Returns the sats of the shares the house paid beyond the reserves."""
+    row = await conn.fetchrow(
+        """
+        WITH s AS (
+            SELECT * FROM unnest($1::bigint[], $2::bigint[]) AS s(id, fee_sats)
+        ), sent AS (
+            UPDATE withdrawals w
+            SET status = 'sent', txid = $3, fee_sats = LEAST(s.fee_sats, w.reserved_fee), updated_at = now()
+            FROM s WHERE w.id = s.id
+            RETURNING w.id, w.user_id, w.sats, w.reserved_fee, w.fee_sats, w.reserved_fee - w.fee_sats AS refund,
+                s.fee_sats - w.fee_sats AS uncovered, nextval('ledger_entries') AS entry_id
+        ), entries AS (
+            INSERT INTO transactions (user_id, type, amount, entry_id, ref)
+            SELECT l.account, l.type, l.amount, sent.entry_id, 'withdrawal:' || sent.id
+            FROM sent, LATERAL (VALUES
+                ($5::bigint, 'withdrawal', -(sent.sats + sent.reserved_fee)),
+                ($6::bigint, 'withdrawal', sent.sats),
+                ($7::bigint, 'withdrawal_fee', sent.fee_sats + sent.uncovered),
+                ($8::bigint, 'withdrawal_fee', -sent.uncovered),
+                (sent.user_id, 'withdrawal_refund', sent.refund)
+            ) AS l(account, type, amount)
+            WHERE l.amount <> 0
+        ), refunds AS (
+            SELECT user_id, SUM(refund) AS refund FROM sent GROUP BY user_id
+        ), refunded AS (
+            UPDATE balances b SET balance = b.balance + r.refund
+            FROM refunds r WHERE b.user_id = r.user_id AND r.refund > 0
+            RETURNING b.user_id
+        ), notified AS (
+            SELECT pg_notify($4, user_id::text) FROM refunded
+        )
+        SELECT (SELECT COUNT(*) FROM notified) AS notified, (SELECT COALESCE(SUM(uncovered), 0) FROM sent) AS uncovered
+        """,
+        [w["id"] for w in batch],
+        shares,
+        txid,
+        BALANCE_CHANNEL,
+        ledger.PENDING,
+        ledger.WITHDRAWN,
+        ledger.FEES,
+        ledger.HOUSE,
+    )
+    return row["uncovered"]
+
+
+async def mark_rejected(conn, batch, error, max_attempts):
+    """Requeues a batch bitcoind refused, failing and refunding exhausted withdrawals"""
+    return await conn.fetch(
+        """
+        WITH rejected AS (
+            UPDATE withdrawals
+            SET status = CASE WHEN attempts >= $2 THEN 'failed' ELSE 'pending' END,
+                error = $3, updated_at = now()
+            WHERE id = ANY($1::bigint[])
+            RETURNING id, user_id, sats + reserved_fee AS refund, status
+        ), entries AS (
+            INSERT INTO transactions (user_id, type, amount, entry_id, ref)
+            SELECT l.account, 'withdrawal_failed', l.amount, r.entry_id, 'withdrawal:' || r.id
+            FROM (SELECT *, nextval('ledger_entries') AS entry_id FROM rejected WHERE status = 'failed') r,
+                LATERAL (VALUES ($5::bigint, -r.refund), (r.user_id, r.refund)) AS l(account, amount)
+        ), refunded AS (
+            UPDATE balances b SET balance = b.balance + r.refund
+            FROM (
+                SELECT user_id, SUM(refund) AS refund FROM rejected
+                WHERE status = 'failed' GROUP BY user_id
+            ) r
+            WHERE b.user_id = r.user_id
+            RETURNING b.user_id
+        ), notified AS (
+            SELECT pg_notify($4, user_id::text) FROM refunded
+        )
+        SELECT id, user_id, status, (SELECT COUNT(*) FROM notified) AS notified FROM rejected
+        """,
+        [w["id"] for w in batch],
+        max_attempts,
+        error,
+        BALANCE_CHANNEL,
+        ledger.PENDING,
+    )
+
+
+async def mark_unknown(conn, batch, error):
+    await conn.execute(
+        "UPDATE withdrawals SET status = 'unknown', error = $2, updated_at = now() WHERE id = ANY($1::bigint[])",
+        [w["id"] for w in batch],
+        error,
+    )
+
+
+async def send_batch(rpc, batch, utxo_index=None):
+    """Pays the batch in one transaction. Returns (txid, number of payment outputs).
+
+    With a utxo_index the inputs are picked by coin_selection and change,
+    if any, goes after the payment outputs. Without one bitcoind selects.
+    """
+    outputs = {}
+    for w in batch:
+        # bitcoind refuses the same address twice in one transaction
+        outputs[w["address"]] = outputs.get(w["address"], 0) + w["sats"]
+    fee_rate = batch[0]["fee_rate"]  # the same for the whole batch, see claim_batch()
+    options = {"change_position": len(outputs)}
+    if utxo_index is not None and len(utxo_index):
+        selection = select_coins(utxo_index, sum(outputs.values()), fee_rate, len(outputs))
+        logging.info(
+            "Selected %s inputs (%s) worth %s sats", len(selection.outpoints), selection.algorithm, selection.total,
+            extra=event(
+                "coin_selection", inputs=len(selection.outpoints), algorithm=selection.algorithm, sats=selection.total
+            ),
+        )
+        options["inputs"] = [{"txid": txid, "vout": vout} for txid, vout in selection.outpoints]
+        options["add_inputs"] = False
+    result = await rpc.send(
+        [{address: Decimal(sats) / Decimal(100_000_000)} for address, sats in outputs.items()],
+        None,
+        "unset",
+        fee_rate,
+        options,
+    )
+    if not result.get("complete"):
+        raise RPCError(None, "transaction was not completed", "send")
+    return result["txid"], len(outputs)
+
+
+async def process_batch(rpc, max_size, max_attempts, utxo_index=None):
+    """Claims and pays one batch. Returns (status, withdrawals) for notifications."""
+    async with db.acquire() as conn:
+        batch = await claim_batch(conn, max_size)
+    if not batch:
+        return None, []
+
+    ids = [w["id"] for w in batch]
+    started = time.perf_counter()
+    try:
+        txid, n_payments = await send_batch(rpc, batch, utxo_index)
+    except (RPCError, InsufficientFunds) as e:
+        logging.error(
+            "bitcoind rejected withdrawal batch %s: %s", ids, e, extra=event("batch_rejected", withdrawal_ids=ids)
+        )
+        if utxo_index is not None:
+            # The index may have offered outputs that are already spent
+            await load_utxos(rpc, utxo_index)
+        async with db.acquire() as conn:
+            rejected = await mark_rejected(conn, batch, str(e), max_attempts)
+        failed = {row["id"] for row in rejected if row["status"] == "failed"}
+        # Withdrawals that were only requeued are retried in a later batch
+        return "failed" if failed else "requeued", [w for w in batch if w["id"] in failed]
+    except Exception as e:
+        # The transaction may or may not have been broadcast, do not retry
+        logging.error(
+            "Withdrawal batch %s ended in an unknown state: %s", ids, e, extra=event("batch_unknown", withdrawal_ids=ids)
+        )
+        async with db.acquire() as conn:
+            await mark_unknown(conn, batch, str(e))
+        return "unknown", batch
+
+    try:
+        tx = await rpc.gettransaction(txid, False, True)
+        fee_sats = int(-tx["fee"] * 100_000_000)
+        shares = prorate_fee(batch, fee_sats)
+        if utxo_index is not None:
+            for vin in tx["decoded"]["vin"]:
+                utxo_index.remove(vin["txid"], vin["vout"])
+            for vout in tx["decoded"]["vout"][n_payments:]:
+                utxo_index.add(txid, vout["n"], int(vout["value"] * 100_000_000))
+    except Exception as e:
+        logging.error(
+            "Could not look up the fee of %s, charging the fee reserves: %s", txid, e,
+            extra=event("batch_fee_unknown", txid=txid),
+        )
+        fee_sats = None
+        shares = [w["reserved_fee"] for w in batch]
+    async with db.acquire() as conn:
+        uncovered = await mark_sent(conn, batch, txid, shares)
+    if uncovered:
+        logging.warning(
+            "Fee of %s was %s sats over the withdrawals' reserves, paid by the house", txid, uncovered,
+            extra=event("batch_fee_uncovered", txid=txid, sats=uncovered),
+        )
+    logging.info(
+        "Sent withdrawal batch %s in %s, fee %s sats", ids, txid, fee_sats,
+        extra=event(
+            "batch_sent",
+            withdrawal_ids=ids,
+            txid=txid,
+            sats=sum(w["sats"] for w in batch),
+            fee_sats=fee_sats,
+            latency_ms=round((time.perf_counter() - started) * 1000, 2),
+        ),
+    )
+    return "sent", [dict(w, txid=txid, fee_sats=min(s, w["reserved_fee"])) for w, s in zip(batch, shares)]